@@ -9,6 +9,7 @@ from flask import (
     send_from_directory, session, send_file
 )
 from sqlalchemy import func
+import click
 
 # ── Imports from your database module ──────────────────────────────────────────
 from database import (
@@ -17,11 +18,21 @@ from database import (
     create_prepared_trip, get_prepared_trips, delete_prepared_trip,
     WorkDay, WorkSegment, PreparedTrip,
     archive_year, list_archived_years, get_trips_by_archived_year,
-    ensure_archive_columns
+    ensure_archive_columns, ensure_sync_columns,
+    ensure_segment_columns, backfill_segment_locations,
+    ensure_owner_columns, ensure_default_user, authenticate, create_user,
+    ensure_open_item_indexes, ensure_change_log_guards
 )
 
+from distance import estimate_trip_miles, get_graph
+from exports import FORMATS, export_args, TRIP_FIELDS, trip_rows, stream_export
+
 # ── Import Blueprints ────────────────────────────────────────────────────────
 from blueprints.work import work_bp
+from blueprints.sync import sync_bp
+from blueprints.reports import reports_bp
+
+import static_assets
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 app = Flask(__name__)
@@ -30,6 +41,11 @@ app.config['SECRET_KEY'] = 'isasecret'
 
 # ── Register Blueprints ────────────────────────────────────────────────────────
 app.register_blueprint(work_bp)
+app.register_blueprint(sync_bp)
+app.register_blueprint(reports_bp)
+
+# Fingerprinted static URLs, precompressed assets, compressed HTML
+static_assets.init_app(app)
 
 # Ensure templates are not cached in debug mode
 app.config['TEMPLATES_AUTO_RELOAD'] = True
@@ -55,28 +71,51 @@ with app.app_context():
     except Exception:
         # non-fatal; app will continue to work but archive UI may fail
         pass
+    ensure_sync_columns(db.engine)
+    ensure_segment_columns(db.engine)
+    backfill_segment_locations()
+    ensure_owner_columns(db.engine)
+    ensure_open_item_indexes(db.engine)
+    ensure_change_log_guards(db.engine)
+    # Fresh installs get user 1, who also owns any rows from the single-user days
+    ensure_default_user(os.getenv('MILEAGE_ADMIN_USER', 'admin'),
+                        os.getenv('MILEAGE_ADMIN_PASSWORD', '2620'))
 
 # ─── AUTH SETUP ───────────────────────────────────────────────────────────────
-from auth import login_required
+from auth import login_required, current_user_id
+
+
+@app.cli.command('create-user')
+@click.argument('username')
+@click.password_option()
+def create_user_command(username, password):
+    """Add another official who can log in to this instance."""
+    create_user(username, password)
+    click.echo(f'User {username} created.')
 
 # ─── LOGIN / LOGOUT ───────────────────────────────────────────────────────────
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
-        if request.form['password'] == '2620':
+        user = authenticate(request.form.get('username', ''), request.form['password'])
+        if user:
             session.permanent = True
             session['logged_in'] = True
+            session['user_id'] = user.id
+            session['username'] = user.username
             flash('You have successfully logged in.', 'success')
             # After login, go to the Work/Officiating chooser
             return redirect(url_for('dashboard'))
         else:
-            flash('Invalid password.', 'danger')
+            flash('Invalid username or password.', 'danger')
     return render_template('login.html')
 
 @app.route('/logout')
 @login_required
 def logout():
     session.pop('logged_in', None)
+    session.pop('user_id', None)
+    session.pop('username', None)
     flash('You have been logged out.', 'success')
     return redirect(url_for('login'))
 
@@ -99,6 +138,7 @@ def home():
 def prepare_trip():
     if request.method == 'POST':
         create_prepared_trip(
+            current_user_id(),
             request.form['date'],
             request.form['time'],
             request.form['sport'],
@@ -113,7 +153,8 @@ def prepare_trip():
 @app.route('/new_trip', methods=['GET', 'POST'])
 @login_required
 def new_trip():
-    prepared = get_prepared_trips()
+    uid = current_user_id()
+    prepared = get_prepared_trips(uid)
     if request.method == 'POST':
         if request.form.get('prepared_id'):
             pid = int(request.form['prepared_id'])
@@ -123,16 +164,16 @@ def new_trip():
                 flash('Prepared trip not found.', 'danger')
             else:
                 start_new_trip(
-                    prep.date, prep.time, prep.sport,
+                    uid, prep.date, prep.time, prep.sport,
                     prep.venue, prep.home_team, prep.away_team,
                     od_start
                 )
-                delete_prepared_trip(pid)
+                delete_prepared_trip(uid, pid)
                 flash('Prepared trip started.', 'success')
         else:
             try:
                 start_new_trip(
-                    request.form['date'], request.form['time'],
+                    uid, request.form['date'], request.form['time'],
                     request.form['sport'], request.form['venue'],
                     request.form['home_team'], request.form['away_team'],
                     float(request.form['odometer_start'])
@@ -149,6 +190,7 @@ def finish_trip_route():
     if request.method == 'POST':
         try:
             finish_trip(
+                current_user_id(),
                 request.form['Level_of_Play'],
                 int(request.form['trip_id']),
                 float(request.form['odometer_end']),
@@ -160,15 +202,21 @@ def finish_trip_route():
             flash('Invalid input. Please check your entries.', 'danger')
         except Exception as e:
             flash(str(e), 'danger')
-    started_trips = get_started_trips()
-    return render_template('officiating_finish_trip.html', trips=started_trips)
+    uid = current_user_id()
+    started_trips = get_started_trips(uid)
+    # Learned round-trip miles per venue, used to suggest the ending odometer
+    graph = get_graph(uid) if started_trips else None
+    estimates = {t.id: estimate_trip_miles(uid, t.venue, graph) for t in started_trips}
+    return render_template('officiating_finish_trip.html', trips=started_trips, estimates=estimates)
 
 @app.route('/trips')
 @login_required
 def view_trips():
-    prepared = get_prepared_trips()
+    uid = current_user_id()
+    prepared = get_prepared_trips(uid)
     # show only non-archived trips in the main view
-    trips = Trip.query.filter(Trip.archived_year == None).order_by(Trip.id.desc()).all()
+    trips = (Trip.query.filter(Trip.user_id == uid, Trip.archived_year == None)
+             .order_by(Trip.id.desc()).all())
     return render_template('officiating_view_trips.html',
                            prepared_trips=prepared,
                            trips=trips)
@@ -176,7 +224,7 @@ def view_trips():
 @app.route('/delete_prepared_trip/<int:prep_id>', methods=['POST'])
 @login_required
 def delete_prepared_trip_route(prep_id):
-    delete_prepared_trip(prep_id)
+    delete_prepared_trip(current_user_id(), prep_id)
     flash('Prepared trip removed.', 'success')
     return redirect(url_for('view_trips'))
 
@@ -184,7 +232,7 @@ def delete_prepared_trip_route(prep_id):
 @app.route('/edit_trip/<int:trip_id>', methods=['GET', 'POST'])
 @login_required
 def edit_trip(trip_id):
-    trip = Trip.query.get_or_404(trip_id)
+    trip = Trip.query.filter_by(id=trip_id, user_id=current_user_id()).first_or_404()
     if request.method == 'POST':
         try:
             trip.date = request.form['date']
@@ -213,7 +261,7 @@ def edit_trip(trip_id):
 @app.route('/delete_trip/<int:trip_id>', methods=['POST'])
 @login_required
 def delete_trip(trip_id):
-    trip = Trip.query.get_or_404(trip_id)
+    trip = Trip.query.filter_by(id=trip_id, user_id=current_user_id()).first_or_404()
     db.session.delete(trip)
     db.session.commit()
     flash('Trip deleted successfully.', 'success')
@@ -222,25 +270,39 @@ def delete_trip(trip_id):
 @app.route('/totals')
 @login_required
 def view_totals():
-    total_miles = db.session.query(func.sum(Trip.miles)).filter(Trip.archived_year == None).scalar() or 0
-    total_revenue = db.session.query(func.sum(Trip.amount_paid)).filter(Trip.archived_year == None).scalar() or 0
+    uid = current_user_id()
+    total_miles = (db.session.query(func.sum(Trip.miles))
+                   .filter(Trip.user_id == uid, Trip.archived_year == None).scalar() or 0)
+    total_revenue = (db.session.query(func.sum(Trip.amount_paid))
+                     .filter(Trip.user_id == uid, Trip.archived_year == None).scalar() or 0)
     return render_template('officiating_totals.html', total_miles=total_miles, total_revenue=total_revenue)
 
 @app.route('/export_data')
 @login_required
 def export_data():
     year = request.args.get('year')
+    fmt = request.args.get('format', 'xlsx')
+    if fmt in FORMATS:
+        # Streamed CSV / NDJSON; optional ?year= and ?month= filters
+        try:
+            y, month, name = export_args(request.args, 'mileage_data', 'current')
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('home'))
+        return stream_export(fmt, name, TRIP_FIELDS, trip_rows(current_user_id(), y, month))
     if year:
         try:
             y = int(year)
         except ValueError:
             flash('Invalid year.', 'danger')
             return redirect(url_for('home'))
-        filenames = export_to_excel(y)
+        filenames = export_to_excel(current_user_id(), y)
     else:
-        filenames = export_to_excel()
+        filenames = export_to_excel(current_user_id())
     if filenames:
-        return send_from_directory(os.getcwd(), filenames[-1], as_attachment=True)
+        download_name = filenames[-1].rsplit('_user', 1)[0] + '.xlsx'
+        return send_from_directory(os.getcwd(), filenames[-1], as_attachment=True,
+                                   download_name=download_name)
     flash('No completed trips to export.', 'warning')
     return redirect(url_for('home'))
 
@@ -258,7 +320,7 @@ def clear_data():
         flash('Invalid year provided.', 'danger')
         return redirect(url_for('archive'))
     try:
-        archive_year(y)
+        archive_year(current_user_id(), y)
         flash(f'Year {y} archived. Current view now shows active year only.', 'success')
     except Exception as e:
         flash(f'Error archiving year: {e}', 'danger')
@@ -276,27 +338,27 @@ def archive():
             flash('Please enter a valid year (e.g. 2024).', 'danger')
             return redirect(url_for('archive'))
         try:
-            archive_year(y)
+            archive_year(current_user_id(), y)
             flash(f'Year {y} archived successfully.', 'success')
             return redirect(url_for('home'))
         except Exception as e:
             flash(f'Error archiving year: {e}', 'danger')
             return redirect(url_for('archive'))
-    years = list_archived_years()
+    years = list_archived_years(current_user_id())
     return render_template('archive.html', archived_years=years)
 
 
 @app.route('/archived')
 @login_required
 def archived_index():
-    years = list_archived_years()
+    years = list_archived_years(current_user_id())
     return render_template('archived_index.html', archived_years=years)
 
 
 @app.route('/archived/<int:year>')
 @login_required
 def archived_year_view(year):
-    trips = get_trips_by_archived_year(year)
+    trips = get_trips_by_archived_year(current_user_id(), year)
     return render_template('archived_year.html', year=year, trips=trips)
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -5,8 +5,19 @@ from flask import session, redirect, url_for, flash
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not session.get('logged_in'):
+        # Sessions from before multi-user support carry no user_id; make them log in again
+        if not session.get('logged_in') or not session.get('user_id'):
             flash('Please log in to access this page.', 'warning')
             return redirect(url_for('login'))
         return f(*args, **kwargs)
-    return decorated_function
\ No newline at end of file
+    return decorated_function
+
+def current_user_id() -> int:
+    """Owner id of the logged-in user; every data query is scoped by it."""
+    return session['user_id']
+
+# The account created by ensure_default_user; it manages the shared settings
+ADMIN_USER_ID = 1
+
+def is_admin() -> bool:
+    return session.get('user_id') == ADMIN_USER_ID
@@ -0,0 +1,65 @@
+from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, session
+from datetime import date
+from io import BytesIO
+
+from reports import tax_year_report, set_rate, pdf_available, render_pdf, DEFAULT_RATES
+from database import MileageRate
+
+from auth import login_required, current_user_id, is_admin
+
+reports_bp = Blueprint('reports', __name__, url_prefix='/reports')
+
+
+@reports_bp.route('/')
+@login_required
+def index():
+    # Default to last year: that's the one being filed
+    y = request.args.get('year', type=int)
+    if y:
+        return redirect(url_for('reports.tax_year', year=y))
+    return render_template('reports/index.html', default_year=date.today().year - 1)
+
+
+@reports_bp.route('/<int:year>')
+@login_required
+def tax_year(year):
+    report = tax_year_report(current_user_id(), year)
+    return render_template('reports/tax_year.html', r=report, pdf_available=pdf_available())
+
+
+@reports_bp.route('/<int:year>.pdf')
+@login_required
+def tax_year_pdf(year):
+    if not pdf_available():
+        flash('PDF output needs the reportlab package; use your browser\'s Print to PDF instead.', 'warning')
+        return redirect(url_for('reports.tax_year', year=year))
+    report = tax_year_report(current_user_id(), year)
+    pdf = render_pdf(report, session.get('username', ''))
+    return send_file(BytesIO(pdf), as_attachment=True, download_name=f'mileage_report_{year}.pdf',
+                     mimetype='application/pdf')
+
+
+@reports_bp.route('/rates', methods=['GET', 'POST'])
+@login_required
+def rates():
+    if request.method == 'POST':
+        # Rates apply to every user's reports
+        if not is_admin():
+            flash('Only the administrator can change mileage rates.', 'danger')
+            return redirect(url_for('reports.rates'))
+        try:
+            y = int(request.form['year'])
+            rate = float(request.form['rate'])
+        except (KeyError, ValueError):
+            flash('Enter a year and a rate in dollars per mile (e.g. 0.67).', 'danger')
+            return redirect(url_for('reports.rates'))
+        if rate < 0 or rate > 5:
+            flash('Rate should be in dollars per mile (e.g. 0.67).', 'danger')
+            return redirect(url_for('reports.rates'))
+        set_rate(y, rate)
+        flash(f'Mileage rate for {y} saved.', 'success')
+        return redirect(url_for('reports.rates'))
+    configured = {r.year: r.rate for r in MileageRate.query.all()}
+    years = sorted(set(configured) | set(DEFAULT_RATES), reverse=True)
+    rows = [(y, configured.get(y), DEFAULT_RATES.get(y)) for y in years]
+    return render_template('reports/rates.html', rows=rows, can_edit=is_admin())
@@ -0,0 +1,220 @@
+from flask import (
+    Blueprint, request, jsonify, current_app, send_from_directory, make_response,
+    session, flash, redirect, url_for
+)
+from datetime import datetime, timezone
+from sqlalchemy.exc import IntegrityError
+
+from database import db, Trip, PreparedTrip, WorkDay, SyncReceipt, get_active_work_day
+from blueprints.work import _start_work_day, _end_work_day
+from changelog import ENTITIES, FEED_LIMIT, changes_since
+
+from auth import login_required, current_user_id
+
+sync_bp = Blueprint('sync', __name__)
+
+
+class SyncConflict(Exception):
+    pass
+
+
+def _parse_iso_utc(raw: str) -> datetime:
+    """ISO timestamp -> naive UTC, matching the stored columns; no offset means UTC."""
+    ts = datetime.fromisoformat(raw.rstrip('Z'))
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def _parse_client_ts(raw):
+    """Parse the client's ISO timestamp (JS toISOString) into a naive UTC datetime."""
+    if not raw or not isinstance(raw, str):
+        return datetime.utcnow()
+    try:
+        return _parse_iso_utc(raw)
+    except ValueError:
+        return datetime.utcnow()
+
+
+def _apply_trip_start(uid, data, queued_at, args):
+    od_start = float(data['odometer_start'])
+    if data.get('prepared_id'):
+        prep = PreparedTrip.query.filter_by(id=int(data['prepared_id']), user_id=uid).first()
+        if not prep:
+            raise SyncConflict('Prepared trip no longer exists.')
+        fields = (prep.date, prep.time, prep.sport, prep.venue, prep.home_team, prep.away_team)
+        db.session.delete(prep)
+    else:
+        fields = (data['date'], data['time'], data['sport'], data['venue'],
+                  data['home_team'], data['away_team'])
+    db.session.add(Trip(*fields, od_start, user_id=uid))
+
+
+def _apply_trip_finish(uid, data, queued_at, args):
+    trip = Trip.query.filter_by(id=int(data['trip_id']), user_id=uid).first()
+    if not trip or trip.status != 'started':
+        raise SyncConflict('Trip is missing or already completed.')
+    if trip.updated_at and trip.updated_at > queued_at:
+        raise SyncConflict('Trip was changed on the server after this was recorded.')
+    odometer_end = float(data['odometer_end'])
+    trip.odometer_end = odometer_end
+    trip.miles = odometer_end - trip.odometer_start
+    trip.Level_of_Play = data.get('Level_of_Play')
+    trip.amount_paid = float(data['amount_paid'])
+    trip.status = 'completed'
+
+
+def _apply_work_start(uid, data, queued_at, args):
+    if get_active_work_day(uid):
+        raise SyncConflict('A Work Day is already started.')
+    _start_work_day(uid, data, queued_at.date())
+
+
+def _apply_work_end(uid, data, queued_at, args):
+    d = WorkDay.query.filter_by(id=int(args['day_id']), user_id=uid).first()
+    if not d or d.status != 'started':
+        raise SyncConflict('Work Day is missing or already ended.')
+    if d.updated_at and d.updated_at > queued_at:
+        raise SyncConflict('Work Day was changed on the server after this was recorded.')
+    _end_work_day(d, data)
+
+
+# Form actions the service worker may queue while offline. Keys match the
+# `type` the client sends; each handler takes (owner id, form data, queued_at, url args)
+# and raises SyncConflict when the server copy is newer or already finished.
+SYNC_HANDLERS = {
+    'trip.start': _apply_trip_start,
+    'trip.finish': _apply_trip_finish,
+    'work.start': _apply_work_start,
+    'work.end': _apply_work_end,
+}
+
+
+def _action_id(raw):
+    return str(raw)[:64] if raw else None
+
+
+@sync_bp.before_app_request
+def _record_direct_submit():
+    """Give a service-worker form post the receipt its queued copy would get.
+
+    The worker sends X-Action-Id with every queueable post and queues the same
+    id if the response never arrives. The receipt is added to the route's own
+    session, so it commits only if the route's write does.
+    """
+    action_id = _action_id(request.headers.get('X-Action-Id'))
+    uid = session.get('user_id')
+    if request.method != 'POST' or not action_id or not uid:
+        return None
+    if db.session.get(SyncReceipt, (uid, action_id)):
+        flash('This entry was already saved.', 'info')
+        return redirect(url_for('dashboard'))
+    db.session.add(SyncReceipt(user_id=uid, action_id=action_id))
+    return None
+
+
+@sync_bp.after_app_request
+def _tag_user(resp):
+    """Tell the service worker whose pages these are, so it can tag queued
+    submits and drop its page cache when someone else logs in."""
+    uid = session.get('user_id')
+    if uid:
+        resp.headers['X-Mileage-User'] = str(uid)
+    return resp
+
+
+@sync_bp.route('/sync', methods=['POST'])
+@login_required
+def sync():
+    """Replay a batch of queued offline form submits in order.
+
+    Body: {"actions": [{"id", "user_id", "type", "queued_at", "args", "data"}, ...]}.
+    Each action runs in its own savepoint so one bad entry doesn't sink the batch;
+    everything that applied is committed together at the end.
+    """
+    uid = current_user_id()
+    payload = request.get_json(silent=True)
+    actions = payload.get('actions', []) if isinstance(payload, dict) else None
+    if not isinstance(actions, list):
+        return jsonify(error='Expected a JSON object with an "actions" list.'), 400
+    results = []
+    for action in actions:
+        if not isinstance(action, dict):
+            results.append({'id': None, 'status': 'error', 'message': 'Action must be an object.'})
+            continue
+        handler = SYNC_HANDLERS.get(action.get('type'))
+        data, args = action.get('data') or {}, action.get('args') or {}
+        result = {'id': action.get('id')}
+        if str(action.get('user_id')) != str(uid):
+            # Queued under another login on this phone; never apply it to this account
+            result.update(status='error', message='Recorded while another user was logged in.')
+            results.append(result)
+            continue
+        if handler is None:
+            result.update(status='error', message='Unknown action type.')
+            results.append(result)
+            continue
+        if not isinstance(data, dict) or not isinstance(args, dict):
+            result.update(status='error', message='Action data and args must be objects.')
+            results.append(result)
+            continue
+        action_id = _action_id(action.get('id'))
+        if action_id and db.session.get(SyncReceipt, (uid, action_id)):
+            # Replayed after a lost response; it already took effect
+            result['status'] = 'applied'
+            results.append(result)
+            continue
+        queued_at = _parse_client_ts(action.get('queued_at'))
+        try:
+            with db.session.begin_nested():
+                handler(uid, data, queued_at, args)
+                if action_id:
+                    db.session.add(SyncReceipt(user_id=uid, action_id=action_id))
+            result['status'] = 'applied'
+        except SyncConflict as e:
+            result.update(status='conflict', message=str(e))
+        except IntegrityError:
+            # e.g. a second started Work Day slipped in from another device
+            result.update(status='conflict', message='Rejected by a database constraint.')
+        except (KeyError, ValueError, TypeError) as e:
+            result.update(status='error', message=f'Invalid input: {e}')
+        results.append(result)
+    db.session.commit()
+    return jsonify(results=results)
+
+
+@sync_bp.route('/changes')
+@login_required
+def changes():
+    """Incremental feed of this user's writes since a cursor.
+
+    ?since=<change id> (or an ISO timestamp), optionally ?entity=trip&id=5 for
+    one row's history and ?limit=. Clients store `next` and send it back as
+    `since`; `more` means another page is waiting.
+    """
+    since_raw = request.args.get('since', '')
+    if not since_raw:
+        since = None
+    elif since_raw.isdigit():
+        since = int(since_raw)
+    else:
+        try:
+            since = _parse_iso_utc(since_raw)
+        except ValueError:
+            return jsonify(error='since must be a change id or an ISO timestamp.'), 400
+    entity = request.args.get('entity')
+    if entity is not None and entity not in ENTITIES.values():
+        return jsonify(error=f'Unknown entity: {entity}'), 400
+    limit = max(1, min(request.args.get('limit', type=int, default=FEED_LIMIT), FEED_LIMIT))
+    entries, next_cursor, more = changes_since(current_user_id(), since, entity,
+                                               request.args.get('id', type=int), limit)
+    return jsonify(changes=entries, next=next_cursor, more=more)
+
+
+@sync_bp.route('/sw.js')
+def service_worker():
+    # Served from the root so the worker's scope covers the whole app
+    resp = make_response(send_from_directory(current_app.static_folder, 'sw.js'))
+    resp.headers['Content-Type'] = 'application/javascript'
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
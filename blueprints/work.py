@@ -1,32 +1,249 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, g
+from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, g, jsonify
 from datetime import date, datetime
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 import calendar
 from io import BytesIO
+from typing import NamedTuple, Optional
+from difflib import SequenceMatcher
+import re
 import openpyxl
-from database import WorkDay, WorkSegment, db
+from database import (
+    WorkDay, WorkSegment, Location, db, get_or_create_location, location_mileage_totals, get_active_work_day,
+    started_day_index_ready
+)
+from distance import estimate_route_miles, estimate_work_day_miles
+from exports import FORMATS, export_args, WORK_FIELDS, work_rows, stream_export
 
-from auth import login_required
+from auth import login_required, current_user_id
 
 work_bp = Blueprint('work', __name__, url_prefix='/work')
 
+
+ACTIVE_DAY_EXISTS = 'You already have a started Work Day. End it or edit it before starting a new one.'
+
+
+def _get_day_or_404(day_id: int) -> WorkDay:
+    return WorkDay.query.filter_by(id=day_id, user_id=current_user_id()).first_or_404()
+
+
+def _other_started_day(d: WorkDay):
+    # Only needed while uq_work_day_user_started is missing (see started_day_index_ready)
+    with db.session.no_autoflush:
+        return WorkDay.query.filter(WorkDay.user_id == d.user_id, WorkDay.status == 'started',
+                                    WorkDay.id != d.id).first()
+
+
+class SegmentInput(NamedTuple):
+    name: str
+    miles: Optional[float] = None
+    odometer: Optional[int] = None
+
+
+# Optional ':miles' and '@odometer' suffixes; anything not fully numeric stays part of the name
+_SEGMENT_RE = re.compile(r'(?P<name>.*?)(?::\s*(?P<miles>\d+(?:\.\d+)?))?(?:\s*@\s*(?P<odo>\d+))?\s*', re.S)
+# 'Meeting 10:30' is a clock time, not 30 leg miles; 'Route 66:12' is 12 miles
+_CLOCK_RE = re.compile(r'\b(?:[01]?\d|2[0-3]):[0-5]\d\s*(?:am|pm)?$', re.I)
+
+
+def _reads_as_clock(text: str, m) -> bool:
+    return '.' not in m.group('miles') and bool(_CLOCK_RE.search(text[:m.end('miles')]))
+
+
+def _parse_segment(text: str) -> SegmentInput:
+    """Parse one stop: 'Name', 'Name:4.5' (leg miles) and/or 'Name@45210' (odometer on arrival).
+
+    Never raises: a name like "Joe's @ 5th" or "Store:abc" is kept whole.
+    """
+    m = _SEGMENT_RE.fullmatch(text)
+    name_end = m.end('name')
+    miles = odometer = None
+    if m.group('miles') is not None:
+        if _reads_as_clock(text, m):
+            name_end = m.end('miles')
+        else:
+            miles = float(m.group('miles'))
+    if m.group('odo') is not None:
+        odometer = int(m.group('odo'))
+    return SegmentInput(text[:name_end].strip(), miles, odometer)
+
+
 def _parse_segments_csv(csv_text: str):
     if not csv_text:
         return []
-    items = [s.strip() for s in csv_text.split(',')]
-    return [s for s in items if s]
+    items = [_parse_segment(s) for s in csv_text.split(',') if s.strip()]
+    return [s for s in items if s.name]
+
+
+def _flash_clock_stops(csv_text: str):
+    """Point out stops whose ':NN' was kept as part of a time rather than read as leg miles."""
+    for text in (csv_text or '').split(','):
+        m = _SEGMENT_RE.fullmatch(text)
+        if m.group('miles') is not None and _reads_as_clock(text, m):
+            name = text[:m.end('miles')].strip()
+            head, _, miles = name.rpartition(':')
+            flash(f'"{name}" was saved as a stop name because it reads as a time. '
+                  f'For {miles} leg miles, write "{head}: {miles}".', 'info')
+
+
+def _format_segments_csv(segments) -> str:
+    """Inverse of _parse_segments_csv, so the edit form round-trips leg values."""
+    parts = []
+    for s in segments:
+        text = s.location_name
+        if s.miles is not None:
+            miles = f'{s.miles:g}'
+            if '.' not in miles and _CLOCK_RE.search(f'{text}:{miles}'):
+                miles += '.0'  # keep it from reading back as a clock time
+            text += f':{miles}'
+        if s.odometer is not None:
+            text += f'@{s.odometer}'
+        parts.append(text)
+    return ', '.join(parts)
+
+
+def _apply_segment(seg: WorkSegment, item: SegmentInput):
+    # Only assign what changed so unchanged rows don't get an UPDATE
+    if seg.location_name != item.name:
+        seg.location_name = item.name
+        seg.location = get_or_create_location(item.name)
+    elif seg.location is None:
+        seg.location = get_or_create_location(item.name)
+    if seg.miles != item.miles:
+        seg.miles = item.miles
+    if seg.odometer != item.odometer:
+        seg.odometer = item.odometer
+
+
+def _new_segment(seq: int, item: SegmentInput) -> WorkSegment:
+    return WorkSegment(seq=seq, location_name=item.name, location=get_or_create_location(item.name),
+                       miles=item.miles, odometer=item.odometer)
+
+
+# Stops are numbered SEQ_GAP apart so one can be slotted between two others
+# without renumbering every row after it
+SEQ_GAP = 1024
+
+
+def _plan_seqs(seqs):
+    """Fill the None entries (new stops) of an ordered seq list.
+
+    Kept stops keep their seq; each run of new ones is spread across the gap
+    between its neighbours. Only when a gap is used up (or the kept seqs are
+    out of order) is the whole day renumbered SEQ_GAP apart.
+    """
+    kept = [s for s in seqs if s is not None]
+    planned = seqs[:]
+    if all(a < b for a, b in zip(kept, kept[1:])):
+        i = 0
+        while i < len(planned):
+            if planned[i] is not None:
+                i += 1
+                continue
+            j = i
+            while j < len(planned) and planned[j] is None:
+                j += 1
+            lo = planned[i - 1] if i else None
+            hi = planned[j] if j < len(planned) else None
+            step = SEQ_GAP if lo is None or hi is None else (hi - lo) // (j - i + 1)
+            if step < 1:
+                break
+            if lo is None:
+                lo = -SEQ_GAP if hi is None else hi - step * (j - i + 1)
+            for k in range(i, j):
+                planned[k] = lo + step * (k - i + 1)
+            i = j
+        else:
+            return planned
+    return [n * SEQ_GAP for n in range(len(seqs))]
+
+
+def _segment_key(name, miles, odometer):
+    return Location.normalize(name), miles, odometer
+
 
 def _upsert_segments(d: WorkDay, csv_text: str):
-    names = _parse_segments_csv(csv_text)
-    d.segments.clear()
-    for i, name in enumerate(names):
-        d.segments.append(WorkSegment(seq=i, location_name=name))
+    """Make d.segments match csv_text, touching only rows that were added, removed or edited.
+
+    Existing rows are matched to the new list by (location, leg values), so
+    inserting or removing a stop doesn't rewrite every row after it.
+    """
+    items = _parse_segments_csv(csv_text)
+    existing = d.segments[:]
+    matcher = SequenceMatcher(
+        None,
+        [_segment_key(s.location_name, s.miles, s.odometer) for s in existing],
+        [_segment_key(*item) for item in items],
+        autojunk=False,
+    )
+    segments = [None] * len(items)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        # Equal runs keep their rows; a replaced run edits rows in place before adding or dropping any
+        reused = (i2 - i1) if tag == 'equal' else min(i2 - i1, j2 - j1)
+        for k in range(reused):
+            segments[j1 + k] = existing[i1 + k]
+    # Seqs are settled before any row is created, so new rows are inserted with their final one
+    seqs = _plan_seqs([seg.seq if seg is not None else None for seg in segments])
+    for j, (seg, seq) in enumerate(zip(segments, seqs)):
+        if seg is None:
+            segments[j] = _new_segment(seq, items[j])
+            d.segments.append(segments[j])  # into the session before the next location lookup
+            continue
+        _apply_segment(seg, items[j])
+        if seg.seq != seq:
+            seg.seq = seq
+    # Puts the list in order; rows left out are deleted by the delete-orphan cascade
+    d.segments = segments
+
 
 def _append_segments(d: WorkDay, csv_text: str):
-    names = _parse_segments_csv(csv_text)
-    start_seq = len(d.segments)
-    for i, name in enumerate(names):
-        d.segments.append(WorkSegment(seq=start_seq + i, location_name=name))
+    items = _parse_segments_csv(csv_text)
+    last = d.segments[-1].seq if d.segments else -SEQ_GAP
+    for i, item in enumerate(items):
+        d.segments.append(_new_segment(last + SEQ_GAP * (i + 1), item))
+
+
+END_BEFORE_START = 'End odometer cannot be less than start odometer.'
+
+
+def _start_work_day(user_id, form, default_day: date) -> WorkDay:
+    """Create and flush a started day from the start form (or a queued copy of it).
+
+    Raises IntegrityError (uq_work_day_user_started) if the user already has a started day.
+    """
+    day_str = form.get('day')
+    start_odo_raw = form.get('start_odo')
+    d = WorkDay(
+        user_id=user_id,
+        day=datetime.strptime(day_str, '%Y-%m-%d').date() if day_str else default_day,
+        status='started',
+        start_odo=int(start_odo_raw) if start_odo_raw else None,  # optional for backfill
+        start_location=form.get('start_location') or None,
+        trip_explanation=form.get('trip_explanation') or None,
+    )
+    db.session.add(d)
+    db.session.flush()
+    _upsert_segments(d, form.get('segments_csv', ''))
+    return d
+
+
+def _end_work_day(d: WorkDay, form):
+    """Apply the end form to a started day; raises ValueError if the odometers are out of order."""
+    if form.get('mode', 'append') == 'overwrite':
+        _upsert_segments(d, form.get('segments_csv', ''))
+    else:
+        _append_segments(d, form.get('append_segments', ''))
+
+    # End-only fields (integers or blank)
+    end_odo_raw = form.get('end_odo')
+    total_miles_raw = form.get('total_miles')
+    d.end_odo = int(end_odo_raw) if end_odo_raw else d.end_odo
+    d.total_miles = int(total_miles_raw) if total_miles_raw else d.total_miles
+    d.trip_explanation = form.get('trip_explanation') or d.trip_explanation
+
+    if d.start_odo is not None and d.end_odo is not None and d.end_odo < d.start_odo:
+        raise ValueError(END_BEFORE_START)
+    d.status = 'ended'
 
 @work_bp.route('/list')
 @login_required
@@ -39,7 +256,7 @@ def list():
     end_d = date(y, m, last_day)
 
     days = (db.session.query(WorkDay)
-            .filter(WorkDay.day >= start_d, WorkDay.day <= end_d)
+            .filter(WorkDay.user_id == current_user_id(), WorkDay.day >= start_d, WorkDay.day <= end_d)
             .order_by(WorkDay.day.desc())
             .all())
 
@@ -65,40 +282,29 @@ def list():
 @login_required
 def start():
     if request.method == 'POST':
-        # Enforce one active Work day at a time
-        active = WorkDay.query.filter_by(status='started').first()
-        if active:
-            flash('You already have a started Work Day. End it or edit it before starting a new one.', 'danger')
+        # One active Work day at a time, enforced by uq_work_day_user_started
+        if not started_day_index_ready() and get_active_work_day(current_user_id()):
+            flash(ACTIVE_DAY_EXISTS, 'danger')
+            return redirect(url_for('work.list'))
+        try:
+            _start_work_day(current_user_id(), request.form, date.today())
+        except IntegrityError:
+            db.session.rollback()
+            flash(ACTIVE_DAY_EXISTS, 'danger')
             return redirect(url_for('work.list'))
 
-        day_str = request.form.get('day')
-        day_val = datetime.strptime(day_str, '%Y-%m-%d').date() if day_str else date.today()
-
-        start_odo_raw = request.form.get('start_odo')
-        start_odo_val = int(start_odo_raw) if start_odo_raw else None  # optional for backfill
-
-        d = WorkDay(
-            day=day_val,
-            status='started',
-            start_odo=start_odo_val,
-            start_location=request.form.get('start_location') or None,
-            trip_explanation=request.form.get('trip_explanation') or None,
-        )
-
-        segments_csv = request.form.get('segments_csv', '')
-        _upsert_segments(d, segments_csv)
-
-        db.session.add(d)
         db.session.commit()
         flash('Work Day started.', 'success')
+        _flash_clock_stops(request.form.get('segments_csv'))
         return redirect(url_for('work.list'))
 
-    return render_template('work/start.html', today=date.today())
+    return render_template('work/start.html', today=date.today(),
+                           active=get_active_work_day(current_user_id()))
 
 @work_bp.route('/update/<int:day_id>', methods=['GET', 'POST'])
 @login_required
 def update(day_id):
-    d = WorkDay.query.get_or_404(day_id)
+    d = _get_day_or_404(day_id)
     if request.method == 'POST':
         _append_segments(d, request.form.get('append_segments', ''))
         d.trip_explanation = request.form.get('trip_explanation') or d.trip_explanation
@@ -107,13 +313,14 @@ def update(day_id):
             d.start_odo = int(request.form['start_odo'])
         db.session.commit()
         flash('Work Day updated successfully.', 'success')
+        _flash_clock_stops(request.form.get('append_segments'))
         return redirect(url_for('work.list'))
     return render_template('work/update.html', d=d)
 
 @work_bp.route('/view/<int:day_id>', methods=['GET', 'POST'])
 @login_required
 def view(day_id):
-    d = WorkDay.query.get_or_404(day_id)
+    d = _get_day_or_404(day_id)
     if request.method == 'POST':
         # Full edit/backfill — all fields editable
         day_in = request.form.get('day')
@@ -131,58 +338,80 @@ def view(day_id):
         d.start_location = request.form.get('start_location') or None
         d.trip_explanation = request.form.get('trip_explanation') or None
 
+        # Re-opening a day trips uq_work_day_user_started if another one is started
+        if d.status == 'started' and not started_day_index_ready() and _other_started_day(d):
+            db.session.rollback()
+            flash(ACTIVE_DAY_EXISTS, 'danger')
+            return redirect(url_for('work.view', day_id=day_id))
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            flash(ACTIVE_DAY_EXISTS, 'danger')
+            return redirect(url_for('work.view', day_id=day_id))
+
         segments_csv = request.form.get('segments_csv', '')
         _upsert_segments(d, segments_csv)
 
         if d.start_odo is not None and d.end_odo is not None and d.end_odo < d.start_odo:
-            flash('End odometer cannot be less than start odometer.', 'danger')
+            flash(END_BEFORE_START, 'danger')
             return redirect(url_for('work.view', day_id=d.id))
 
         db.session.commit()
         flash('Work Day updated.', 'success')
+        _flash_clock_stops(segments_csv)
         return redirect(url_for('work.list'))
 
-    segments_csv = ', '.join([s.location_name for s in d.segments])
+    segments_csv = _format_segments_csv(d.segments)
     return render_template('work/view.html', d=d, segments_csv=segments_csv)
 
 @work_bp.route('/end/<int:day_id>', methods=['GET', 'POST'])
 @login_required
 def end(day_id):
-    d = WorkDay.query.get_or_404(day_id)
+    d = _get_day_or_404(day_id)
     if d.status != 'started':
         flash('This work day is not started.', 'danger')
         return redirect(url_for('work.list'))
 
     if request.method == 'POST':
-        mode = request.form.get('mode', 'append')  # append | overwrite
-        if mode == 'overwrite':
-            _upsert_segments(d, request.form.get('segments_csv', ''))
-        else:
-            _append_segments(d, request.form.get('append_segments', ''))
-
-        # End-only fields (integers or blank)
-        end_odo_raw = request.form.get('end_odo')
-        total_miles_raw = request.form.get('total_miles')
+        try:
+            _end_work_day(d, request.form)
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return redirect(url_for('work.end', day_id=day_id))
 
-        d.end_odo = int(end_odo_raw) if end_odo_raw else d.end_odo
-        d.total_miles = int(total_miles_raw) if total_miles_raw else d.total_miles
-        d.trip_explanation = request.form.get('trip_explanation') or d.trip_explanation
-
-        if d.start_odo is not None and d.end_odo is not None and d.end_odo < d.start_odo:
-            flash('End odometer cannot be less than start odometer.', 'danger')
-            return redirect(url_for('work.end', day_id=d.id))
-
-        d.status = 'ended'
         db.session.commit()
         flash('Work day ended successfully.', 'success')
+        _flash_clock_stops(request.form.get('segments_csv') if request.form.get('mode') == 'overwrite'
+                           else request.form.get('append_segments'))
         return redirect(url_for('work.list'))
 
-    return render_template('work/end.html', d=d)
+    return render_template('work/end.html', d=d, estimate=estimate_work_day_miles(current_user_id(), d))
+
+@work_bp.route('/estimate')
+@login_required
+def estimate():
+    # Live suggestion for the end form: ?stops=Osage,City Hall,Ace
+    stops = [s.name for s in _parse_segments_csv(request.args.get('stops', ''))]
+    miles = estimate_route_miles(current_user_id(), stops) if len(stops) > 1 else None
+    return jsonify(miles=miles)
+
+@work_bp.route('/locations')
+@login_required
+def locations():
+    # Visits and leg miles per location; optional ?year= narrows to one year
+    y = request.args.get('year', type=int)
+    if y:
+        totals = location_mileage_totals(current_user_id(), date(y, 1, 1), date(y, 12, 31))
+    else:
+        totals = location_mileage_totals(current_user_id())
+    return render_template('work/locations.html', totals=totals, year=y)
 
 @work_bp.route('/delete/<int:day_id>', methods=['POST'])
 @login_required
 def delete(day_id):
-    d = WorkDay.query.get_or_404(day_id)
+    d = _get_day_or_404(day_id)
     db.session.delete(d)
     db.session.commit()
     flash('Work day deleted.', 'success')
@@ -191,9 +420,21 @@ def delete(day_id):
 @work_bp.route('/export')
 @login_required
 def export():
+    uid = current_user_id()
+    fmt = request.args.get('format', 'xlsx')
+    if fmt in FORMATS:
+        # Streamed CSV / NDJSON; optional ?year= and ?month= filters
+        try:
+            y, m, name = export_args(request.args, 'work_mileage', 'all')
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('work.list'))
+        return stream_export(fmt, name, WORK_FIELDS, work_rows(uid, y, m))
+
     # For simplicity, export all available months grouped by YYYY-MM
     months = (db.session.query(
         func.strftime('%Y-%m', WorkDay.day).label('ym'))
+        .filter(WorkDay.user_id == uid)
         .group_by('ym')
         .order_by('ym')
         .all())
@@ -218,7 +459,7 @@ def export():
         end_d = date(y, m, last_day)
 
         days = (WorkDay.query
-            .filter(WorkDay.day >= start_d, WorkDay.day <= end_d)
+            .filter(WorkDay.user_id == uid, WorkDay.day >= start_d, WorkDay.day <= end_d)
             .order_by(WorkDay.day)
             .all())
 
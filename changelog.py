@@ -0,0 +1,137 @@
+"""Append-only change log for trips, prepared trips, work days and segments.
+
+Every flush that inserts, edits or deletes one of those rows appends a
+`change_log` entry on the same connection, so the entry commits or rolls back
+with the write itself (savepoints included). Entries hold field-level diffs
+only, which keeps edits like edit_trip or a segment rewrite auditable without
+copying whole rows. Ids are assigned under SQLite's single writer lock, so a
+client that remembers the last id it saw never misses a committed change.
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import event, func, inspect, select
+
+from database import db, Trip, PreparedTrip, WorkDay, WorkSegment, ChangeLog
+
+ENTITIES = {
+    Trip: 'trip',
+    PreparedTrip: 'prepared_trip',
+    WorkDay: 'work_day',
+    WorkSegment: 'work_segment',
+}
+
+# Bookkeeping columns that would only add noise to every entry
+_SKIP = {'id', 'user_id', 'created_at', 'updated_at', 'location_id'}
+
+FEED_LIMIT = 500
+
+
+def _fields(obj):
+    return [a.key for a in inspect(obj).mapper.column_attrs if a.key not in _SKIP]
+
+
+def _snapshot(obj):
+    """Non-null field values, for inserts and deletes."""
+    return {f: getattr(obj, f) for f in _fields(obj) if getattr(obj, f) is not None}
+
+
+def _diff(obj):
+    """{field: [old, new]} for fields changed since the object was loaded."""
+    state = inspect(obj)
+    changes = {}
+    for f in _fields(obj):
+        hist = state.attrs[f].history
+        if not hist.has_changes():
+            continue
+        old = hist.deleted[0] if hist.deleted else None
+        new = hist.added[0] if hist.added else None
+        if old != new:
+            changes[f] = [old, new]
+    return changes
+
+
+def _owner(conn, obj):
+    if not isinstance(obj, WorkSegment):
+        return obj.user_id
+    # A segment removed from its day has already lost the back-reference
+    hist = inspect(obj).attrs.work_day.history
+    parent = obj.work_day or next((d for d in hist.deleted if d is not None), None)
+    if parent is not None:
+        return parent.user_id
+    return conn.execute(select(WorkDay.user_id).where(WorkDay.id == obj.work_day_id)).scalar()
+
+
+def _log(connection, obj, entity, op, changes):
+    connection.execute(ChangeLog.__table__.insert(), dict(
+        user_id=_owner(connection, obj), entity=entity, entity_id=obj.id, op=op,
+        changes=json.dumps(changes, separators=(',', ':'), default=str), changed_at=datetime.utcnow(),
+    ))
+
+
+# Mapper events rather than after_flush: rows removed by the delete-orphan
+# cascade (dropped segments) never show up in session.deleted.
+def _listen(model, entity):
+    @event.listens_for(model, 'after_insert')
+    def _inserted(mapper, connection, target):
+        _log(connection, target, entity, 'insert', _snapshot(target))
+
+    @event.listens_for(model, 'after_update')
+    def _updated(mapper, connection, target):
+        # Pre-flush history is still available here
+        changes = _diff(target)
+        if changes:
+            _log(connection, target, entity, 'update', changes)
+
+    @event.listens_for(model, 'after_delete')
+    def _deleted(mapper, connection, target):
+        _log(connection, target, entity, 'delete', _snapshot(target))
+
+
+for _model, _entity in ENTITIES.items():
+    _listen(_model, _entity)
+
+
+# -----------------------------
+# Feed
+# -----------------------------
+def _as_dict(entry: ChangeLog):
+    return {
+        'id': entry.id,
+        'entity': entry.entity,
+        'entity_id': entry.entity_id,
+        'op': entry.op,
+        'changes': json.loads(entry.changes),
+        'at': entry.changed_at.isoformat() + 'Z',
+    }
+
+
+def changes_since(user_id, since=None, entity=None, entity_id=None, limit=FEED_LIMIT):
+    """Entries after cursor `since` (a change id or a naive UTC datetime), oldest first.
+
+    Returns (entries, next_cursor, more); next_cursor is always a change id, to be
+    passed back as `since`.
+    """
+    q = ChangeLog.query.filter(ChangeLog.user_id == user_id)
+    if isinstance(since, datetime):
+        q = q.filter(ChangeLog.changed_at > since)
+    elif since is not None:
+        q = q.filter(ChangeLog.id > since)
+    if entity is not None:
+        q = q.filter(ChangeLog.entity == entity)
+        if entity_id is not None:
+            q = q.filter(ChangeLog.entity_id == entity_id)
+    rows = q.order_by(ChangeLog.id).limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        next_cursor = rows[-1].id
+    elif isinstance(since, int):
+        next_cursor = since
+    else:
+        # Nothing new: hand back the id the time (or "now") corresponds to, never an empty cursor
+        latest = db.session.query(func.max(ChangeLog.id)).filter(ChangeLog.user_id == user_id)
+        if since is not None:
+            latest = latest.filter(ChangeLog.changed_at <= since)
+        next_cursor = latest.scalar() or 0
+    return [_as_dict(r) for r in rows], next_cursor, more
@@ -1,12 +1,81 @@
+import logging
+import sqlite3
 from collections import defaultdict
 from datetime import datetime, date
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import func, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from openpyxl import Workbook
+from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
 
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_conn, connection_record):
+    """WAL lets readers (e.g. a slow streamed export) and a writer work at the same time."""
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    cur = dbapi_conn.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')
+    # Wait for the one writer instead of failing with "database is locked"
+    cur.execute('PRAGMA busy_timeout=5000')
+    cur.close()
+
+
+log = logging.getLogger(__name__)
+
+# Unique partial index behind "one started Work Day per user"
+STARTED_DAY_INDEX = 'uq_work_day_user_started'
+
+# Rendered inline rather than as a bound parameter, so SQLite can match it
+# against the WHERE clause of the partial "open items" indexes below.
+STARTED = db.literal_column("'started'")
+
+# -----------------------------
+# Users
+# -----------------------------
+class User(db.Model):
+    __tablename__ = 'users'
+
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), nullable=False, unique=True)
+    password_hash = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def set_password(self, password: str):
+        self.password_hash = generate_password_hash(password)
+
+    def check_password(self, password: str) -> bool:
+        return check_password_hash(self.password_hash, password)
+
+
+def create_user(username: str, password: str) -> User:
+    u = User(username=username)
+    u.set_password(password)
+    db.session.add(u)
+    db.session.commit()
+    return u
+
+
+def authenticate(username: str, password: str):
+    u = User.query.filter_by(username=username).first()
+    if u and u.check_password(password):
+        return u
+    return None
+
+
+def ensure_default_user(username: str, password: str):
+    """Create user 1 on a fresh install so rows written before multi-user support keep an owner."""
+    if User.query.first() is None:
+        u = User(id=1, username=username)
+        u.set_password(password)
+        db.session.add(u)
+        db.session.commit()
+
+
 # -----------------------------
 # Work module models
 # -----------------------------
@@ -14,8 +83,8 @@ class WorkDay(db.Model):
     __tablename__ = 'work_day'
 
     id = db.Column(db.Integer, primary_key=True)
-    # Single-user for now, future-proof with a user_id
-    user_id = db.Column(db.Integer, nullable=False, default=1)
+    # Owner; every work-day query is scoped by it
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
     # Logical work day (CST date chosen by you). Only this date matters.
     day = db.Column(db.Date, nullable=False, index=True)
@@ -51,6 +120,12 @@ class WorkDay(db.Model):
             '(total_miles IS NULL OR total_miles >= 0)',
             name='ck_work_day_nonneg'
         ),
+        # Owner-leading indexes so one user's lookups never scan another's rows
+        db.Index('ix_work_day_user_day', 'user_id', 'day'),
+        db.Index('ix_work_day_user_status', 'user_id', 'status'),
+        # At most one started day per user, enforced by the database itself
+        db.Index(STARTED_DAY_INDEX, 'user_id', 'status', unique=True,
+                 sqlite_where=db.text("status = 'started'")),
     )
 
     def compute_total_miles(self) -> int:
@@ -60,6 +135,22 @@ class WorkDay(db.Model):
         return self.total_miles or 0
 
 
+class Location(db.Model):
+    """Deduplicated place names used by work segments (matched case-insensitively)."""
+    __tablename__ = 'location'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), nullable=False)
+    # Lower-cased, whitespace-collapsed name; what deduplication keys on
+    name_key = db.Column(db.String(255), nullable=False, unique=True)
+
+    segments = db.relationship('WorkSegment', back_populates='location')
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        return ' '.join(name.split()).lower()
+
+
 class WorkSegment(db.Model):
     __tablename__ = 'work_segment'
 
@@ -72,8 +163,44 @@ class WorkSegment(db.Model):
     )
     seq = db.Column(db.Integer, nullable=False, default=0)  # order in the day
     location_name = db.Column(db.String(255), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=True, index=True)
+
+    # Optional per-leg values: miles driven to reach this stop, odometer on arrival
+    miles = db.Column(db.Float, nullable=True)
+    odometer = db.Column(db.Integer, nullable=True)
 
     work_day = db.relationship('WorkDay', back_populates='segments')
+    location = db.relationship('Location', back_populates='segments')
+
+
+def get_or_create_location(name: str) -> Location:
+    key = Location.normalize(name)
+    loc = Location.query.filter_by(name_key=key).first()
+    if loc is None:
+        # The table is shared by all users; another request may insert the same key first
+        try:
+            with db.session.begin_nested():
+                loc = Location(name=' '.join(name.split()), name_key=key)
+                db.session.add(loc)
+        except IntegrityError:
+            loc = Location.query.filter_by(name_key=key).one()
+    return loc
+
+
+def location_mileage_totals(user_id, start_d: date = None, end_d: date = None):
+    """Visits and summed leg miles per location for one user, optionally limited to a day range."""
+    q = (db.session.query(
+            Location.name,
+            func.count(WorkSegment.id).label('visits'),
+            func.sum(WorkSegment.miles).label('miles'))
+         .join(WorkSegment, WorkSegment.location_id == Location.id)
+         .join(WorkDay, WorkDay.id == WorkSegment.work_day_id)
+         .filter(WorkDay.user_id == user_id))
+    if start_d is not None:
+        q = q.filter(WorkDay.day >= start_d)
+    if end_d is not None:
+        q = q.filter(WorkDay.day <= end_d)
+    return q.group_by(Location.id).order_by(func.count(WorkSegment.id).desc(), Location.name).all()
 
 
 # -----------------------------
@@ -83,6 +210,7 @@ class Trip(db.Model):
     __tablename__ = 'trips'
 
     id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     date = db.Column(db.String, nullable=False)
     time = db.Column(db.String, nullable=False)
     sport = db.Column(db.String, nullable=False)
@@ -97,8 +225,19 @@ class Trip(db.Model):
     status = db.Column(db.String, nullable=False, default='started')
     # Null means active/current year; integer year (e.g. 2024) means archived into that year
     archived_year = db.Column(db.Integer, nullable=True, index=True)
+    # Used by offline sync to resolve conflicts (nullable for rows created before the column existed)
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_trips_user_archived_id', 'user_id', 'archived_year', 'id'),
+        db.Index('ix_trips_user_status', 'user_id', 'status'),
+        # Only open (started, non-archived) trips; keeps get_started_trips() small as history grows
+        db.Index('ix_trips_user_open', 'user_id', 'status',
+                 sqlite_where=db.text("status = 'started' AND archived_year IS NULL")),
+    )
 
-    def __init__(self, date, time, sport, venue, home_team, away_team, odometer_start):
+    def __init__(self, date, time, sport, venue, home_team, away_team, odometer_start, *, user_id):
+        self.user_id = user_id
         self.date = date
         self.time = time
         self.sport = sport
@@ -124,6 +263,7 @@ class PreparedTrip(db.Model):
     __tablename__ = 'prepared_trips'
 
     id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     date = db.Column(db.String,  nullable=False)
     time = db.Column(db.String,  nullable=False)
     sport = db.Column(db.String, nullable=False)
@@ -133,15 +273,19 @@ class PreparedTrip(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     archived_year = db.Column(db.Integer, nullable=True, index=True)
 
+    __table_args__ = (
+        db.Index('ix_prepared_trips_user_archived', 'user_id', 'archived_year', 'created_at'),
+    )
 
-def start_new_trip(date, time, sport, venue, home_team, away_team, odometer_start):
-    new_trip = Trip(date, time, sport, venue, home_team, away_team, odometer_start)
+
+def start_new_trip(user_id, date, time, sport, venue, home_team, away_team, odometer_start):
+    new_trip = Trip(date, time, sport, venue, home_team, away_team, odometer_start, user_id=user_id)
     db.session.add(new_trip    )
     db.session.commit()
 
 
-def finish_trip(Level_of_Play, trip_id, odometer_end, amount_paid):
-    trip = Trip.query.get(trip_id)
+def finish_trip(user_id, Level_of_Play, trip_id, odometer_end, amount_paid):
+    trip = Trip.query.filter_by(id=trip_id, user_id=user_id).first()
     if trip and trip.status == 'started':
         trip.odometer_end = odometer_end
         trip.miles = odometer_end - trip.odometer_start
@@ -153,22 +297,28 @@ def finish_trip(Level_of_Play, trip_id, odometer_end, amount_paid):
         raise ValueError("Invalid trip ID or the trip is already completed.")
 
 
-def get_started_trips():
+def get_started_trips(user_id):
     # exclude archived trips from active lists
-    return Trip.query.filter(Trip.status == 'started', Trip.archived_year == None).all()
+    return Trip.query.filter(Trip.user_id == user_id, Trip.status == STARTED, Trip.archived_year == None).all()
+
 
+def get_active_work_day(user_id):
+    return WorkDay.query.filter(WorkDay.user_id == user_id, WorkDay.status == STARTED).first()
 
-def export_to_excel(year: int = None):
+
+def export_to_excel(user_id, year: int = None):
     """Export completed trips to Excel.
 
     If year is None, export current (non-archived) completed trips.
     If year is provided, export trips archived for that year or trips whose date year matches when not archived.
     """
     if year is None:
-        entries = Trip.query.filter(Trip.status == 'completed', Trip.archived_year == None).all()
+        entries = Trip.query.filter(Trip.user_id == user_id, Trip.status == 'completed',
+                                    Trip.archived_year == None).all()
     else:
         # Prefer archived_year marker; fall back to date field parsing for safety
         entries = Trip.query.filter(
+            Trip.user_id == user_id,
             (Trip.archived_year == year) | (func.substr(Trip.date, 1, 4) == str(year)),
             Trip.status == 'completed'
         ).all()
@@ -183,7 +333,8 @@ def export_to_excel(year: int = None):
 
     filenames = []
     for year, year_entries in entries_by_year.items():
-        filename = f"mileage_data_{year}.xlsx"
+        # Per-user file on disk; the download is still named mileage_data_<year>.xlsx
+        filename = f"mileage_data_{year}_user{user_id}.xlsx"
         wb = Workbook()
         summary_ws = wb.active
         summary_ws.title = 'Summary'
@@ -218,16 +369,16 @@ def export_to_excel(year: int = None):
     return filenames
 
 
-def create_prepared_trip(date, time, sport, venue, home_team, away_team):
+def create_prepared_trip(user_id, date, time, sport, venue, home_team, away_team):
     p = PreparedTrip(
-        date=date, time=time, sport=sport,
+        user_id=user_id, date=date, time=time, sport=sport,
         venue=venue, home_team=home_team, away_team=away_team
     )
     db.session.add(p)
     db.session.commit()
 
 
-def archive_year(year: int):
+def archive_year(user_id, year: int):
     """Mark all trips and prepared trips for the given year as archived.
 
     This sets the `archived_year` integer on matching rows so they are excluded
@@ -236,12 +387,14 @@ def archive_year(year: int):
     str_year = str(year)
     # Update Trip rows where the date starts with 'YYYY-' OR already have that year
     trips = Trip.query.filter(
+        Trip.user_id == user_id,
         (func.substr(Trip.date, 1, 4) == str_year) & (Trip.archived_year == None)
     ).all()
     for t in trips:
         t.archived_year = year
 
     preps = PreparedTrip.query.filter(
+        PreparedTrip.user_id == user_id,
         (func.substr(PreparedTrip.date, 1, 4) == str_year) & (PreparedTrip.archived_year == None)
     ).all()
     for p in preps:
@@ -250,62 +403,255 @@ def archive_year(year: int):
     db.session.commit()
 
 
-def list_archived_years():
-    years = db.session.query(Trip.archived_year).filter(Trip.archived_year != None).distinct().all()
+def list_archived_years(user_id):
+    years = (db.session.query(Trip.archived_year)
+             .filter(Trip.user_id == user_id, Trip.archived_year != None)
+             .distinct().all())
     # Flatten tuples and sort descending
     ys = sorted({y[0] for y in years if y[0] is not None}, reverse=True)
     return ys
 
 
-def get_trips_by_archived_year(year: int):
-    return Trip.query.filter(Trip.archived_year == year).order_by(Trip.id.desc()).all()
+def get_trips_by_archived_year(user_id, year: int):
+    return (Trip.query.filter(Trip.user_id == user_id, Trip.archived_year == year)
+            .order_by(Trip.id.desc()).all())
 
 
-def ensure_archive_columns(engine):
-    """Ensure archived_year columns exist in the SQLite tables. Adds columns if missing.
+# -----------------------------
+# Tax report models
+# -----------------------------
+class MileageRate(db.Model):
+    """Standard mileage rate (dollars per mile) used for a tax year's deduction."""
+    __tablename__ = 'mileage_rate'
 
-    This is a small, idempotent migration helper so adding this feature doesn't
-    require external migration tooling.
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    rate = db.Column(db.Float, nullable=False)
+
+
+class MonthlySummary(db.Model):
+    """Cached per-month totals for the tax report.
+
+    A row exists only while it is current: writes to trips / work days delete
+    the rows of the months they touch (see reports.py), and the report
+    recomputes just those months.
+    """
+    __tablename__ = 'monthly_summary'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True, autoincrement=False)
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    month = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    source = db.Column(db.String(16), primary_key=True)  # officiating | work
+    entries = db.Column(db.Integer, nullable=False, default=0)
+    miles = db.Column(db.Float, nullable=False, default=0)
+    income = db.Column(db.Float, nullable=False, default=0)
+
+
+# -----------------------------
+# Offline sync
+# -----------------------------
+class SyncReceipt(db.Model):
+    """A queued offline action that /sync already applied, keyed by the client's action id.
+
+    Written in the action's own savepoint, so a batch that is replayed after a
+    lost response doesn't apply anything twice.
+    """
+    __tablename__ = 'sync_receipt'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True, autoincrement=False)
+    action_id = db.Column(db.String(64), primary_key=True)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# -----------------------------
+# Change log
+# -----------------------------
+class ChangeLog(db.Model):
+    """Append-only history of trip / work-day writes (see changelog.py).
+
+    `changes` is compact JSON: {field: value} for inserts and deletes,
+    {field: [old, new]} for updates. `id` doubles as the /changes feed cursor.
     """
-    # Only implemented for SQLite (simple ALTER TABLE ADD COLUMN)
+    __tablename__ = 'change_log'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    entity = db.Column(db.String(32), nullable=False)  # trip | prepared_trip | work_day | work_segment
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(8), nullable=False)  # insert | update | delete
+    changes = db.Column(db.Text, nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.CheckConstraint("op in ('insert','update','delete')", name='ck_change_log_op'),
+        # History of one row, and a user's feed after a cursor
+        db.Index('ix_change_log_entity', 'entity', 'entity_id', 'changed_at'),
+        db.Index('ix_change_log_user_id', 'user_id', 'id'),
+    )
+
+
+def _sqlite_add_columns(engine, table, columns):
+    """Add any of `columns` ({name: sql type}) missing from `table`. SQLite only, idempotent."""
+    if engine.dialect.name != 'sqlite':
+        return
+    # Resolve sqlite DB path
+    db_path = None
     try:
-        if engine.dialect.name != 'sqlite':
-            return
-        # Resolve sqlite DB path
+        db_path = engine.url.database
+    except Exception:
         db_path = None
-        try:
-            db_path = engine.url.database
-        except Exception:
-            db_path = None
-        if not db_path:
-            return
-
-        # Use sqlite3 directly to run PRAGMA and ALTER statements reliably
-        import sqlite3 as _sqlite3
-        conn = _sqlite3.connect(db_path)
+    if not db_path:
+        return
+
+    # Use sqlite3 directly to run PRAGMA and ALTER statements reliably
+    import sqlite3 as _sqlite3
+    conn = _sqlite3.connect(db_path)
+    try:
         cur = conn.cursor()
-        cur.execute("PRAGMA table_info('trips')")
-        cols = [r[1] for r in cur.fetchall()]
-        if 'archived_year' not in cols:
-            cur.execute("ALTER TABLE trips ADD COLUMN archived_year INTEGER;")
-        cur.execute("PRAGMA table_info('prepared_trips')")
+        cur.execute(f"PRAGMA table_info('{table}')")
         cols = [r[1] for r in cur.fetchall()]
-        if 'archived_year' not in cols:
-            cur.execute("ALTER TABLE prepared_trips ADD COLUMN archived_year INTEGER;")
+        for name, sql_type in columns.items():
+            if name not in cols:
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {sql_type};")
         conn.commit()
+    finally:
         conn.close()
+
+
+def _is_partial(ix) -> bool:
+    return ix.dialect_options['sqlite'].get('where') is not None
+
+
+def _create_missing_indexes(engine, *models):
+    """create_all() skips indexes on tables that already exist; add any declared ones that are missing.
+
+    Partial indexes are left to ensure_open_item_indexes(), since existing rows may violate them.
+    """
+    for model in models:
+        for ix in model.__table__.indexes:
+            if _is_partial(ix):
+                continue
+            try:
+                ix.create(engine, checkfirst=True)
+            except Exception as e:
+                log.warning('Could not create index %s: %s', ix.name, e)
+
+
+def ensure_archive_columns(engine):
+    """Ensure archived_year columns exist in the SQLite tables. Adds columns if missing.
+
+    This is a small, idempotent migration helper so adding this feature doesn't
+    require external migration tooling.
+    """
+    try:
+        _sqlite_add_columns(engine, 'trips', {'archived_year': 'INTEGER'})
+        _sqlite_add_columns(engine, 'prepared_trips', {'archived_year': 'INTEGER'})
     except Exception:
         # If anything goes wrong, silently continue; the app can still run but archiving will fail until fixed.
         pass
 
 
-def get_prepared_trips():
+def ensure_sync_columns(engine):
+    """Ensure trips.updated_at exists so offline sync can compare timestamps."""
+    try:
+        _sqlite_add_columns(engine, 'trips', {'updated_at': 'DATETIME'})
+    except Exception:
+        pass
+
+
+def ensure_segment_columns(engine):
+    """Add the location/per-leg columns to work_segment and create any missing indexes."""
+    try:
+        _sqlite_add_columns(engine, 'work_segment', {
+            'location_id': 'INTEGER REFERENCES location(id)',
+            'miles': 'REAL',
+            'odometer': 'INTEGER',
+        })
+        _create_missing_indexes(engine, WorkSegment)
+    except Exception:
+        pass
+
+
+def ensure_owner_columns(engine):
+    """Add user_id to the officiating tables (existing rows belong to user 1) and the owner indexes."""
+    try:
+        for table in ('trips', 'prepared_trips'):
+            _sqlite_add_columns(engine, table, {'user_id': 'INTEGER NOT NULL DEFAULT 1'})
+        _create_missing_indexes(engine, WorkDay, Trip, PreparedTrip)
+    except Exception:
+        pass
+
+
+def ensure_open_item_indexes(engine):
+    """Create the partial open-item indexes one by one.
+
+    The unique started-day index can't be built while a user still has two
+    started days; that user has to end one, and the index is retried next start.
+    """
+    for ix in (WorkDay.__table__.indexes | Trip.__table__.indexes):
+        if not _is_partial(ix):
+            continue
+        try:
+            ix.create(engine, checkfirst=True)
+        except Exception as e:
+            log.warning('Could not create index %s: %s', ix.name, e)
+            if ix.name == STARTED_DAY_INDEX:
+                log.warning('Some user has more than one started Work Day; one active day per user '
+                            'is checked in the app until they end the extra ones and the app restarts.')
+    # Without statistics SQLite may pick the wider (user_id, status) index over
+    # the equally-keyed partial one; ANALYZE lets it see the partial is tiny.
+    try:
+        with engine.begin() as conn:
+            conn.exec_driver_sql('ANALYZE')
+    except Exception:
+        pass
+
+
+_started_day_index_ready = False
+
+
+def started_day_index_ready() -> bool:
+    """True once uq_work_day_user_started exists; until then callers must check for a started day themselves."""
+    global _started_day_index_ready
+    if not _started_day_index_ready:
+        _started_day_index_ready = db.session.execute(
+            db.text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"),
+            {'name': STARTED_DAY_INDEX}).first() is not None
+    return _started_day_index_ready
+
+
+def ensure_change_log_guards(engine):
+    """Make change_log append-only at the database level: UPDATE and DELETE abort."""
+    if engine.dialect.name != 'sqlite':
+        return
+    try:
+        with engine.begin() as conn:
+            for action in ('UPDATE', 'DELETE'):
+                conn.exec_driver_sql(
+                    f"CREATE TRIGGER IF NOT EXISTS change_log_no_{action.lower()} "
+                    f"BEFORE {action} ON change_log "
+                    "BEGIN SELECT RAISE(ABORT, 'change_log is append-only'); END")
+    except Exception:
+        pass
+
+
+def backfill_segment_locations():
+    """Link segments saved before the location table existed to their Location row."""
+    legacy = WorkSegment.query.filter(WorkSegment.location_id == None).all()
+    for seg in legacy:
+        seg.location = get_or_create_location(seg.location_name)
+    if legacy:
+        db.session.commit()
+
+
+def get_prepared_trips(user_id):
     # Exclude archived prepared trips from the active prepared list
-    return PreparedTrip.query.filter(PreparedTrip.archived_year == None).order_by(PreparedTrip.created_at).all()
+    return (PreparedTrip.query
+            .filter(PreparedTrip.user_id == user_id, PreparedTrip.archived_year == None)
+            .order_by(PreparedTrip.created_at).all())
 
 
-def delete_prepared_trip(prep_id):
-    p = PreparedTrip.query.get(prep_id)
+def delete_prepared_trip(user_id, prep_id):
+    p = PreparedTrip.query.filter_by(id=prep_id, user_id=user_id).first()
     if p:
         db.session.delete(p)
         db.session.commit()
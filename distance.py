@@ -0,0 +1,162 @@
+"""Offline distance estimates learned from odometer-bearing history.
+
+Completed trips teach home <-> venue distances (half the round trip), and work
+days teach the legs between consecutive stops (from per-leg miles, arrival
+odometers, or the one leg left unknown once the day's total is known). Legs are
+averaged into an undirected graph; a route is estimated as the sum of shortest
+paths between its consecutive stops. Shortest paths are memoized per graph, and
+the graph is rebuilt only when the underlying rows change. Each user gets their
+own graph, since officials sharing an instance don't share a home.
+"""
+import heapq
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+from sqlalchemy import func
+
+from database import db, Trip, WorkDay, Location, ChangeLog
+
+# Node for the officiating trips' implicit start/end point
+HOME = '__home__'
+
+
+def _key(name):
+    return Location.normalize(name) if name else None
+
+
+class DistanceGraph:
+    def __init__(self):
+        # node -> neighbour -> [sum of observed miles, observations]
+        self._edges = defaultdict(dict)
+        self.shortest = lru_cache(maxsize=4096)(self._dijkstra)
+
+    def observe(self, a, b, miles):
+        if not a or not b or a == b or miles is None or miles <= 0:
+            return
+        for x, y in ((a, b), (b, a)):
+            obs = self._edges[x].setdefault(y, [0.0, 0])
+            obs[0] += miles
+            obs[1] += 1
+
+    def _dijkstra(self, src, dst):
+        if src == dst:
+            return 0.0
+        if src not in self._edges or dst not in self._edges:
+            return None
+        best = {src: 0.0}
+        heap = [(0.0, src)]
+        while heap:
+            dist, node = heapq.heappop(heap)
+            if node == dst:
+                return dist
+            if dist > best.get(node, float('inf')):
+                continue
+            for nxt, (total, count) in self._edges[node].items():
+                nd = dist + total / count
+                if nd < best.get(nxt, float('inf')):
+                    best[nxt] = nd
+                    heapq.heappush(heap, (nd, nxt))
+        return None
+
+    def route_miles(self, keys):
+        """Sum of shortest paths between consecutive nodes; None if any leg is unknown."""
+        total = 0.0
+        for a, b in zip(keys, keys[1:]):
+            leg = self.shortest(a, b)
+            if leg is None:
+                return None
+            total += leg
+        return total
+
+
+def _learn_trips(graph, user_id):
+    rows = (db.session.query(Trip.venue, Trip.miles)
+            .filter(Trip.user_id == user_id, Trip.status == 'completed', Trip.miles != None, Trip.miles > 0))
+    for venue, miles in rows:
+        graph.observe(HOME, _key(venue), miles / 2.0)
+
+
+def _learn_work_days(graph, user_id):
+    days = (WorkDay.query
+            .filter(WorkDay.user_id == user_id, WorkDay.status == 'ended')
+            .options(db.selectinload(WorkDay.segments))
+            .all())
+    for d in days:
+        # [node, odometer on arrival, miles driven to reach it]
+        stops = [[_key(d.start_location), d.start_odo, None]] if d.start_location else []
+        stops += [[_key(s.location_name), s.odometer, s.miles] for s in d.segments]
+        if stops and stops[-1][1] is None:
+            stops[-1][1] = d.end_odo  # the day ends at the last stop
+        legs = []
+        for (a, odo_a, _), stop_b in zip(stops, stops[1:]):
+            b, odo_b, leg_miles = stop_b
+            if leg_miles is not None:
+                if odo_b is None and odo_a is not None:
+                    stop_b[1] = odo_a + leg_miles  # carry the odometer forward
+                legs.append((a, b, leg_miles))
+            elif odo_a is not None and odo_b is not None and odo_b > odo_a:
+                legs.append((a, b, float(odo_b - odo_a)))
+            else:
+                legs.append((a, b, None))
+        unknown = [leg for leg in legs if leg[2] is None]
+        total = d.compute_total_miles()
+        if len(unknown) == 1 and total:
+            # The day's total pins down the single leg nobody measured
+            rest = total - sum(leg[2] for leg in legs if leg[2] is not None)
+            legs = [(a, b, rest if m is None else m) for a, b, m in legs]
+        for a, b, m in legs:
+            graph.observe(a, b, m)
+
+
+def _fingerprint(user_id):
+    """Changes whenever rows the graph learns from change.
+
+    Every trip, work day and segment write appends to the change log, so its
+    newest id for the user is enough. The owner-indexed row counts cover data
+    from before the change log existed.
+    """
+    changes = db.session.query(func.max(ChangeLog.id)).filter(ChangeLog.user_id == user_id).scalar()
+    trips = db.session.query(func.count(Trip.id)).filter(Trip.user_id == user_id).scalar()
+    days = db.session.query(func.count(WorkDay.id)).filter(WorkDay.user_id == user_id).scalar()
+    return changes, trips, days
+
+
+_lock = threading.Lock()
+# user_id -> (fingerprint, graph)
+_cached = {}
+
+
+def get_graph(user_id) -> DistanceGraph:
+    fp = _fingerprint(user_id)
+    with _lock:
+        cached = _cached.get(user_id)
+        if cached is None or cached[0] != fp:
+            graph = DistanceGraph()
+            _learn_trips(graph, user_id)
+            _learn_work_days(graph, user_id)
+            cached = _cached[user_id] = (fp, graph)
+        return cached[1]
+
+
+def estimate_trip_miles(user_id, venue, graph: DistanceGraph = None):
+    """Round-trip estimate from home to `venue` and back.
+
+    Pass `graph` (from get_graph) when estimating several venues in one request.
+    """
+    graph = graph or get_graph(user_id)
+    one_way = graph.shortest(HOME, _key(venue))
+    return None if one_way is None else round(one_way * 2, 1)
+
+
+def estimate_route_miles(user_id, stops):
+    keys = [k for k in (_key(s) for s in stops) if k]
+    miles = get_graph(user_id).route_miles(keys)
+    return None if miles is None else round(miles)
+
+
+def estimate_work_day_miles(user_id, d: WorkDay):
+    stops = ([d.start_location] if d.start_location else []) + [s.location_name for s in d.segments]
+    if len(stops) < 2:
+        return None
+    return estimate_route_miles(user_id, stops)
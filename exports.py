@@ -0,0 +1,130 @@
+"""Streaming CSV / NDJSON exports.
+
+Unlike the openpyxl exports these never build the whole file in memory: rows
+are pulled from the database in batches (`yield_per`) and written to the
+response as they arrive, so a full-history dump starts downloading at once.
+"""
+import csv
+import json
+import calendar
+from io import StringIO
+from datetime import date
+
+from flask import Response, stream_with_context
+from sqlalchemy import func
+
+from database import db, Trip, WorkDay
+
+BATCH_SIZE = 500
+FORMATS = ('csv', 'ndjson')
+
+TRIP_FIELDS = [
+    'id', 'date', 'time', 'sport', 'venue', 'home_team', 'away_team',
+    'odometer_start', 'odometer_end', 'miles', 'Level_of_Play', 'amount_paid', 'status',
+]
+WORK_FIELDS = [
+    'id', 'day', 'start_odo', 'end_odo', 'total_miles', 'start_location',
+    'segments', 'trip_explanation', 'created_at', 'updated_at', 'status',
+]
+
+
+def export_args(args, prefix: str, everything: str):
+    """Read the optional ?year= and ?month= filters of a streamed export.
+
+    Returns (year, month, filename), e.g. 'work_mileage_2024_03' or
+    f'{prefix}_{everything}' when unfiltered. Raises ValueError with a
+    message to flash when either value is not valid.
+    """
+    year = month = None
+    if args.get('year'):
+        try:
+            year = int(args['year'])
+        except ValueError:
+            raise ValueError('Invalid year.')
+        if not date.min.year <= year <= date.max.year:
+            raise ValueError('Invalid year.')
+    if args.get('month'):
+        try:
+            month = int(args['month'])
+        except ValueError:
+            raise ValueError('Invalid month.')
+        if not 1 <= month <= 12:
+            raise ValueError('Invalid month.')
+    name = f'{prefix}_{year or everything}' + (f'_{month:02d}' if month else '')
+    return year, month, name
+
+
+def trip_rows(user_id, year: int = None, month: int = None):
+    """Completed trips with the same year semantics as export_to_excel, optionally one month."""
+    q = Trip.query.filter(Trip.user_id == user_id, Trip.status == 'completed')
+    if year is None:
+        q = q.filter(Trip.archived_year == None)
+    else:
+        q = q.filter((Trip.archived_year == year) | (func.substr(Trip.date, 1, 4) == str(year)))
+    if month is not None:
+        q = q.filter(func.substr(Trip.date, 6, 2) == f'{month:02d}')
+    for t in q.order_by(Trip.date, Trip.id).yield_per(BATCH_SIZE):
+        yield {f: getattr(t, f) for f in TRIP_FIELDS}
+
+
+def work_rows(user_id, year: int = None, month: int = None):
+    q = WorkDay.query.filter(WorkDay.user_id == user_id)
+    if year is not None:
+        if month is not None:
+            start_d = date(year, month, 1)
+            end_d = date(year, month, calendar.monthrange(year, month)[1])
+        else:
+            start_d, end_d = date(year, 1, 1), date(year, 12, 31)
+        q = q.filter(WorkDay.day >= start_d, WorkDay.day <= end_d)
+    elif month is not None:
+        q = q.filter(func.strftime('%m', WorkDay.day) == f'{month:02d}')
+    q = q.options(db.selectinload(WorkDay.segments)).order_by(WorkDay.day, WorkDay.id)
+    for d in q.yield_per(BATCH_SIZE):
+        yield {
+            'id': d.id,
+            'day': d.day.isoformat(),
+            'start_odo': d.start_odo,
+            'end_odo': d.end_odo,
+            'total_miles': d.compute_total_miles(),
+            'start_location': d.start_location or '',
+            'segments': ' to '.join([s.location_name for s in d.segments]),
+            'trip_explanation': d.trip_explanation or '',
+            'created_at': d.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'updated_at': d.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'status': d.status,
+        }
+
+
+def _csv_chunks(fields, rows):
+    buf = StringIO()
+    writer = csv.DictWriter(buf, fieldnames=fields)
+    writer.writeheader()
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % BATCH_SIZE == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def _ndjson_chunks(rows):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row, default=str))
+        if len(lines) == BATCH_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def stream_export(fmt: str, filename: str, fields, rows) -> Response:
+    """Wrap a row generator in a streamed attachment response (`fmt` is 'csv' or 'ndjson')."""
+    if fmt == 'csv':
+        body, mimetype = _csv_chunks(fields, rows), 'text/csv'
+    else:
+        body, mimetype = _ndjson_chunks(rows), 'application/x-ndjson'
+    resp = Response(stream_with_context(body), mimetype=mimetype)
+    resp.headers['Content-Disposition'] = f'attachment; filename={filename}.{fmt}'
+    return resp
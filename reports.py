@@ -0,0 +1,282 @@
+"""Tax-year mileage report.
+
+Officiating trips and work days are rolled up into per-month totals cached in
+`monthly_summary`. Any flush that inserts, edits or deletes a trip or work day
+drops the cached rows for the months it touches (old and new values), so a
+report only recomputes the months that changed since it was last generated.
+"""
+import calendar
+from io import BytesIO
+from itertools import chain
+
+from sqlalchemy import event, func, case, cast, and_, inspect, select, literal, union_all, Integer
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from database import db, Trip, WorkDay, MileageRate, MonthlySummary
+
+try:
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+except ImportError:  # PDF output is optional; the HTML report always works
+    letter = None
+
+# IRS standard business mileage rates (dollars per mile); a row in
+# mileage_rate overrides these, and later years fall back to the latest known rate.
+DEFAULT_RATES = {
+    2023: 0.655,
+    2024: 0.67,
+    2025: 0.70,
+}
+
+
+def rate_for_year(year: int):
+    """Return (rate, origin) where origin is 'configured', 'default' or 'assumed'."""
+    row = db.session.get(MileageRate, year)
+    if row is not None:
+        return row.rate, 'configured'
+    if year in DEFAULT_RATES:
+        return DEFAULT_RATES[year], 'default'
+    known = dict(DEFAULT_RATES)
+    known.update({r.year: r.rate for r in MileageRate.query.filter(MileageRate.year < year)})
+    earlier = [y for y in known if y < year]
+    if earlier:
+        return known[max(earlier)], 'assumed'
+    return known[min(known)], 'assumed'
+
+
+def set_rate(year: int, rate: float):
+    row = db.session.get(MileageRate, year)
+    if row is None:
+        db.session.add(MileageRate(year=year, rate=rate))
+    else:
+        row.rate = rate
+    db.session.commit()
+
+
+# -----------------------------
+# Cache invalidation
+# -----------------------------
+def _trip_month(date_str):
+    try:
+        return int(date_str[:4]), int(date_str[5:7])
+    except (TypeError, ValueError):
+        return None
+
+
+def _day_month(day):
+    return (day.year, day.month) if day is not None else None
+
+
+def _values(obj, attr):
+    """Current and pre-flush values of an attribute."""
+    hist = inspect(obj).attrs[attr].history
+    return set(hist.added) | set(hist.unchanged) | set(hist.deleted)
+
+
+def _stale_keys(obj):
+    if isinstance(obj, Trip):
+        source, months = 'officiating', {_trip_month(v) for v in _values(obj, 'date')}
+    elif isinstance(obj, WorkDay):
+        source, months = 'work', {_day_month(v) for v in _values(obj, 'day')}
+    else:
+        return set()
+    return {(uid, ym[0], ym[1], source)
+            for uid in _values(obj, 'user_id') if uid is not None
+            for ym in months if ym is not None}
+
+
+@event.listens_for(Session, 'after_flush')
+def _drop_stale_months(session, flush_context):
+    # Pre-flush history is still available here, and we're inside the same transaction
+    stale = set()
+    for obj in chain(session.new, session.deleted):
+        stale |= _stale_keys(obj)
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            stale |= _stale_keys(obj)
+    if not stale:
+        return
+    t = MonthlySummary.__table__
+    conn = session.connection()
+    for user_id, year, month, source in stale:
+        conn.execute(t.delete().where(and_(
+            t.c.user_id == user_id, t.c.year == year, t.c.month == month, t.c.source == source)))
+
+
+# -----------------------------
+# Aggregation
+# -----------------------------
+# Same rule as WorkDay.compute_total_miles(), in SQL
+_WORK_MILES = case(
+    (and_(WorkDay.start_odo != None, WorkDay.end_odo != None),
+     func.max(0, WorkDay.end_odo - WorkDay.start_odo)),
+    else_=func.coalesce(WorkDay.total_miles, 0),
+)
+
+
+_SUMMARY_COLUMNS = ['user_id', 'year', 'month', 'source', 'entries', 'miles', 'income']
+
+
+def _months(months):
+    """The given month numbers as a one-column subquery, so empty months still get a row."""
+    rows = [select(literal(m, Integer).label('month')) for m in months]
+    return (union_all(*rows) if len(rows) > 1 else rows[0]).subquery('months')
+
+
+def _officiating_select(user_id, year, months):
+    m = _months(months)
+    month_col = cast(func.substr(Trip.date, 6, 2), Integer)
+    return (select(literal(user_id), literal(year), m.c.month, literal('officiating'),
+                   func.count(Trip.id),
+                   func.coalesce(func.sum(Trip.miles), 0.0),
+                   func.coalesce(func.sum(Trip.amount_paid), 0.0))
+            .select_from(m.outerjoin(Trip, and_(
+                Trip.user_id == user_id, Trip.status == 'completed',
+                func.substr(Trip.date, 1, 4) == str(year), month_col == m.c.month)))
+            .group_by(m.c.month))
+
+
+def _work_select(user_id, year, months):
+    m = _months(months)
+    month_col = cast(func.strftime('%m', WorkDay.day), Integer)
+    return (select(literal(user_id), literal(year), m.c.month, literal('work'),
+                   func.count(WorkDay.id), func.coalesce(func.sum(_WORK_MILES), 0.0), literal(0.0))
+            .select_from(m.outerjoin(WorkDay, and_(
+                WorkDay.user_id == user_id, WorkDay.status == 'ended',
+                func.strftime('%Y', WorkDay.day) == str(year), month_col == m.c.month)))
+            .group_by(m.c.month))
+
+
+_SELECTS = {'officiating': _officiating_select, 'work': _work_select}
+
+
+def _cached(user_id, year):
+    return {(r.month, r.source): dict(entries=r.entries, miles=r.miles, income=r.income)
+            for r in MonthlySummary.query.filter_by(user_id=user_id, year=year)}
+
+
+def _missing(totals):
+    return {source: [m for m in range(1, 13) if (m, source) not in totals] for source in _SELECTS}
+
+
+def monthly_totals(user_id, year: int):
+    """{(month, source): {entries, miles, income}}, filling in only months missing from the cache.
+
+    Missing months are aggregated and stored by a single INSERT ... SELECT, so
+    a cached row is exactly what the database held when it was written: a
+    write committed before it is counted, and one committed after it deletes
+    the row again (see _drop_stale_months).
+    """
+    totals = _cached(user_id, year)
+    missing = _missing(totals)
+    if not any(missing.values()):
+        return totals
+    t = MonthlySummary.__table__
+    try:
+        for source, months in missing.items():
+            if months:
+                # OR REPLACE: two requests may fill the same month at once
+                db.session.execute(t.insert().prefix_with('OR REPLACE').from_select(
+                    _SUMMARY_COLUMNS, _SELECTS[source](user_id, year, months)))
+        db.session.commit()
+    except OperationalError:
+        # Lost the write lock to a concurrent writer; fall through to live numbers
+        db.session.rollback()
+    totals = _cached(user_id, year)
+    for source, months in _missing(totals).items():
+        if months:
+            for _, _, month, _, entries, miles, income in db.session.execute(
+                    _SELECTS[source](user_id, year, months)):
+                totals[(month, source)] = dict(entries=entries, miles=float(miles), income=float(income))
+    return totals
+
+
+def tax_year_report(user_id, year: int):
+    rate, rate_origin = rate_for_year(year)
+    totals = monthly_totals(user_id, year)
+    months = []
+    for m in range(1, 13):
+        off, work = totals[(m, 'officiating')], totals[(m, 'work')]
+        miles = off['miles'] + work['miles']
+        months.append({
+            'month': m,
+            'name': calendar.month_name[m],
+            'officiating_trips': off['entries'],
+            'officiating_miles': off['miles'],
+            'officiating_income': off['income'],
+            'work_days': work['entries'],
+            'work_miles': work['miles'],
+            'total_miles': miles,
+            'deduction': miles * rate,
+        })
+
+    def total(key):
+        return sum(row[key] for row in months)
+
+    officiating_deduction = total('officiating_miles') * rate
+    return {
+        'year': year,
+        'rate': rate,
+        'rate_origin': rate_origin,
+        'months': months,
+        'officiating_trips': total('officiating_trips'),
+        'officiating_miles': total('officiating_miles'),
+        'officiating_income': total('officiating_income'),
+        'officiating_deduction': officiating_deduction,
+        'officiating_net': total('officiating_income') - officiating_deduction,
+        'work_days': total('work_days'),
+        'work_miles': total('work_miles'),
+        'work_deduction': total('work_miles') * rate,
+        'total_miles': total('total_miles'),
+        'total_deduction': total('deduction'),
+    }
+
+
+# -----------------------------
+# PDF output
+# -----------------------------
+def pdf_available() -> bool:
+    return letter is not None
+
+
+def render_pdf(report, username: str = '') -> bytes:
+    """Render tax_year_report() output as a one-page PDF (requires reportlab)."""
+    styles = getSampleStyleSheet()
+    bio = BytesIO()
+    doc = SimpleDocTemplate(bio, pagesize=letter, title=f"Mileage report {report['year']}")
+    rate_note = f"${report['rate']:.3f}/mile ({report['rate_origin']})"
+    story = [
+        Paragraph(f"Mileage Report {report['year']}" + (f" - {username}" if username else ''), styles['Title']),
+        Paragraph(f"Standard mileage rate: {rate_note}", styles['Normal']),
+        Spacer(1, 12),
+    ]
+    summary = [
+        ['', 'Entries', 'Miles', 'Income', 'Deduction'],
+        ['Officiating', report['officiating_trips'], f"{report['officiating_miles']:,.1f}",
+         f"${report['officiating_income']:,.2f}", f"${report['officiating_deduction']:,.2f}"],
+        ['Work', report['work_days'], f"{report['work_miles']:,.1f}", '', f"${report['work_deduction']:,.2f}"],
+        ['Total', '', f"{report['total_miles']:,.1f}", '', f"${report['total_deduction']:,.2f}"],
+        ['Officiating income less mileage', '', '', '', f"${report['officiating_net']:,.2f}"],
+    ]
+    monthly = [['Month', 'Trips', 'Officiating mi', 'Income', 'Work days', 'Work mi', 'Total mi', 'Deduction']]
+    for row in report['months']:
+        monthly.append([
+            row['name'], row['officiating_trips'], f"{row['officiating_miles']:,.1f}",
+            f"${row['officiating_income']:,.2f}", row['work_days'], f"{row['work_miles']:,.1f}",
+            f"{row['total_miles']:,.1f}", f"${row['deduction']:,.2f}",
+        ])
+    style = TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.grey),
+        ('ALIGN', (1, 1), (-1, -1), 'RIGHT'),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+    ])
+    for data in (summary, monthly):
+        table = Table(data)
+        table.setStyle(style)
+        story += [table, Spacer(1, 12)]
+    doc.build(story)
+    return bio.getvalue()
@@ -0,0 +1,41 @@
+// Registers the service worker and asks it to replay queued offline submits
+// whenever the page loads or the connection comes back. Also fills in
+// client-side date defaults.
+(function () {
+  // A page served from the offline cache carries the day it was rendered;
+  // date fields marked data-default-today start at the phone's own date instead.
+  function fillToday() {
+    var now = new Date();
+    var today = [now.getFullYear(), ('0' + (now.getMonth() + 1)).slice(-2), ('0' + now.getDate()).slice(-2)].join('-');
+    document.querySelectorAll('input[type=date][data-default-today]').forEach(function (input) {
+      input.value = today;
+    });
+  }
+  if (document.readyState === 'loading') document.addEventListener('DOMContentLoaded', fillToday);
+  else fillToday();
+
+  if (!('serviceWorker' in navigator)) return;
+
+  function replay() {
+    if (navigator.serviceWorker.controller) navigator.serviceWorker.controller.postMessage('replay');
+  }
+
+  navigator.serviceWorker.register('/sw.js').then(function () {
+    if (navigator.onLine) replay();
+  });
+  window.addEventListener('online', replay);
+
+  navigator.serviceWorker.addEventListener('message', function (event) {
+    if (!event.data || event.data.kind !== 'sync-results') return;
+    var main = document.querySelector('main');
+    if (!main) return;
+    event.data.results.forEach(function (r) {
+      var div = document.createElement('div');
+      div.className = 'flash ' + (r.status === 'applied' ? 'success' : r.status === 'conflict' ? 'warning' : 'danger');
+      div.textContent = r.status === 'applied'
+        ? 'Offline entry synced.'
+        : 'Offline entry not applied: ' + (r.message || r.status);
+      main.insertBefore(div, main.firstChild);
+    });
+  });
+})();
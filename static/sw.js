@@ -0,0 +1,272 @@
+// Service worker: caches the static assets and page shells, and queues the
+// trip / work-day form submits in IndexedDB when the Pi is unreachable.
+// Queued submits are replayed in one batch through POST /sync.
+// Cached pages and queued submits belong to whoever was logged in: both are
+// dropped on logout or when the server reports a different user.
+
+const CACHE = 'mileage-shell-v3';
+const SHELL = [
+  '/static/favicon.ico',
+  '/static/whistle.png',
+  '/static/offline.js',
+  '/static/manifest.webmanifest',
+  '/dashboard',
+  '/',
+  '/new_trip',
+  '/finish_trip',
+  '/work/list',
+  '/work/start',
+];
+
+// Stylesheets pulled from CDNs by base.html; cached opaque so pages still render offline
+const CDN_HOSTS = ['cdn.jsdelivr.net', 'cdnjs.cloudflare.com'];
+
+// Visited pages kept for offline viewing, oldest dropped first
+const MAX_PAGES = 30;
+
+// Form posts that may be recorded offline -> sync action type
+const QUEUEABLE = [
+  { re: /^\/new_trip$/, type: 'trip.start' },
+  { re: /^\/finish_trip$/, type: 'trip.finish' },
+  { re: /^\/work\/start$/, type: 'work.start' },
+  { re: /^\/work\/end\/(\d+)$/, type: 'work.end', args: m => ({ day_id: m[1] }) },
+];
+
+const DB_NAME = 'mileage-offline';
+const STORE = 'queue';
+const META = 'meta';
+
+// ── IndexedDB helpers ────────────────────────────────────────────────────────
+function openDb() {
+  return new Promise((resolve, reject) => {
+    const req = indexedDB.open(DB_NAME, 2);
+    req.onupgradeneeded = () => {
+      const db = req.result;
+      if (!db.objectStoreNames.contains(STORE)) db.createObjectStore(STORE, { keyPath: 'id' });
+      if (!db.objectStoreNames.contains(META)) db.createObjectStore(META);
+    };
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+function withStore(name, mode, fn) {
+  return openDb().then(db => new Promise((resolve, reject) => {
+    const tx = db.transaction(name, mode);
+    const result = fn(tx.objectStore(name));
+    tx.oncomplete = () => resolve(result && 'result' in result ? result.result : undefined);
+    tx.onerror = () => reject(tx.error);
+  }));
+}
+
+const queueAdd = action => withStore(STORE, 'readwrite', store => store.put(action));
+const queueAll = () => withStore(STORE, 'readonly', store => store.getAll());
+const queueDelete = ids => withStore(STORE, 'readwrite', store => ids.forEach(id => store.delete(id)));
+const queueClear = () => withStore(STORE, 'readwrite', store => store.clear());
+const metaGet = key => withStore(META, 'readonly', store => store.get(key));
+const metaSet = (key, value) => withStore(META, 'readwrite', store => store.put(value, key));
+
+// ── Lifecycle ────────────────────────────────────────────────────────────────
+self.addEventListener('install', event => {
+  event.waitUntil(caches.open(CACHE).then(cache =>
+    // Pages behind login may redirect; cache whatever succeeds
+    Promise.all(SHELL.map(url => fetch(url, { credentials: 'same-origin' })
+      .then(res => (res.ok && !res.redirected) ? cache.put(url, res) : null)
+      .catch(() => null)))
+  ).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+  event.waitUntil(caches.keys()
+    .then(keys => Promise.all(keys.filter(k => k !== CACHE).map(k => caches.delete(k))))
+    .then(() => self.clients.claim()));
+});
+
+// ── Fetch routing ────────────────────────────────────────────────────────────
+self.addEventListener('fetch', event => {
+  const req = event.request;
+  const url = new URL(req.url);
+  if (url.origin !== self.location.origin) {
+    if (req.method === 'GET' && CDN_HOSTS.includes(url.hostname)) {
+      event.respondWith(caches.match(req).then(hit => hit || fetchAndCache(req)));
+    }
+    return;
+  }
+
+  if (req.method === 'POST') {
+    const match = QUEUEABLE.map(q => ({ q, m: url.pathname.match(q.re) })).find(x => x.m);
+    if (match) event.respondWith(postOrQueue(req, match.q, match.m));
+    return;
+  }
+  if (req.method !== 'GET') return;
+
+  if (url.pathname.startsWith('/static/')) {
+    event.respondWith(staticAsset(req, url));
+  } else if (req.mode === 'navigate' && url.pathname === '/logout') {
+    event.respondWith(logout(req));
+  } else if (req.mode === 'navigate') {
+    // Only the exact URL: /work/list?month=1 must not show another month's list
+    event.respondWith(navigate(req).catch(() =>
+      caches.match(req).then(hit => hit || offlinePage('This page is not available offline.'))));
+  }
+});
+
+function staticAsset(req, url) {
+  // A ?v=<hash> URL never changes content, so an exact cached copy is current.
+  // Unversioned URLs go to the network first. Any cached version of the file
+  // (ignoring the query) is only the offline fallback.
+  const offline = () => caches.match(req, { ignoreSearch: true }).then(hit => {
+    if (hit) return hit;
+    throw new Error('offline');
+  });
+  const network = () => fetchAndCache(req).then(res => {
+    if (res.ok) pruneVersions(url);
+    return res;
+  }).catch(offline);
+  if (!url.searchParams.has('v')) return network();
+  return caches.match(req).then(hit => hit || network());
+}
+
+function pruneVersions(url) {
+  // Drop the copies of this file cached under older ?v= hashes
+  return caches.open(CACHE).then(cache => cache.keys().then(keys => Promise.all(keys
+    .filter(k => { const u = new URL(k.url); return u.pathname === url.pathname && u.search !== url.search; })
+    .map(k => cache.delete(k)))));
+}
+
+function fetchAndCache(req) {
+  return fetch(req).then(res => {
+    if ((res.ok && !res.redirected) || res.type === 'opaque') {
+      const copy = res.clone();
+      caches.open(CACHE).then(cache => cache.put(req, copy));
+    }
+    return res;
+  });
+}
+
+function navigate(req) {
+  return fetch(req).then(res => noteUser(res).then(() => {
+    if (cacheablePage(res)) {
+      const copy = res.clone();
+      caches.open(CACHE).then(cache => cache.put(req, copy)).then(trimPages);
+    }
+    return res;
+  }));
+}
+
+function cacheablePage(res) {
+  // Exports and PDFs are navigations too; they are never kept
+  const type = res.headers.get('Content-Type') || '';
+  const disposition = res.headers.get('Content-Disposition') || '';
+  return res.ok && !res.redirected && type.startsWith('text/html') && !disposition.startsWith('attachment');
+}
+
+function trimPages() {
+  return caches.open(CACHE).then(cache => cache.keys().then(keys => {
+    const pages = keys.filter(k => {
+      const u = new URL(k.url);
+      return u.origin === self.location.origin && !u.pathname.startsWith('/static/');
+    });
+    return Promise.all(pages.slice(0, Math.max(0, pages.length - MAX_PAGES)).map(k => cache.delete(k)));
+  }));
+}
+
+function noteUser(res) {
+  // The server tags every logged-in response with X-Mileage-User
+  const user = res.headers.get('X-Mileage-User');
+  return metaGet('user').then(prev => {
+    if (prev === user || (prev === undefined && user === null)) return null;
+    // Someone else (or no one) is logged in now: their pages must not be served from the cache
+    return metaSet('user', user).then(() => (prev === undefined ? null : clearPages()));
+  });
+}
+
+function clearPages() {
+  return caches.delete(CACHE);
+}
+
+function logout(req) {
+  // Send anything still queued while the session is alive; once that worked, nothing
+  // of this user's stays on the phone. Offline the logout itself fails anyway.
+  return replay()
+    .then(() => queueClear())
+    .then(() => Promise.all([clearPages(), metaSet('user', null)]))
+    .catch(() => null)
+    .then(() => fetch(req))
+    .catch(() => offlinePage('Log out needs a connection to the tracker.'));
+}
+
+function postOrQueue(req, q, m) {
+  // The id goes out with the post too, so the server can tell a replay of it apart
+  const id = `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+  return req.formData().then(form => fetch(req.url, {
+    method: 'POST',
+    body: form,
+    credentials: 'same-origin',
+    redirect: 'manual',
+    headers: { 'X-Action-Id': id },
+  }).catch(() => {
+    const data = {};
+    form.forEach((v, k) => { data[k] = v; });
+    return metaGet('user').then(user => queueAdd({
+      id,
+      user_id: user,
+      type: q.type,
+      args: q.args ? q.args(m) : {},
+      queued_at: new Date().toISOString(),
+      data,
+    })).then(() => {
+      if (self.registration.sync) self.registration.sync.register('mileage-replay').catch(() => null);
+      return offlinePage('Saved on this device. It will sync when the tracker is reachable again.');
+    });
+  }));
+}
+
+function offlinePage(message) {
+  const html = `<!doctype html><html><head><meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Offline - Mileage Tracker</title></head><body style="font-family: sans-serif; padding: 16px;">
+<p>${message}</p><p><a href="/dashboard">Back to Dashboard</a></p></body></html>`;
+  return new Response(html, { headers: { 'Content-Type': 'text/html; charset=utf-8' } });
+}
+
+// ── Replay ───────────────────────────────────────────────────────────────────
+let replaying = null;
+
+function replay() {
+  if (replaying) return replaying;
+  replaying = Promise.all([queueAll(), metaGet('user')]).then(([all, user]) => {
+    // Nobody logged in: keep everything until a session is back. Submits recorded
+    // under another login are dropped, never sent with this session.
+    const queued = user ? all || [] : [];
+    const stale = queued.filter(a => a.user_id !== user);
+    const actions = queued.filter(a => a.user_id === user);
+    const dropped = stale.length ? queueDelete(stale.map(a => a.id)) : Promise.resolve();
+    if (!actions.length) return dropped.then(() => null);
+    actions.sort((a, b) => a.queued_at.localeCompare(b.queued_at));
+    return dropped.then(() => fetch('/sync', {
+      method: 'POST',
+      credentials: 'same-origin',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ actions }),
+    }).then(res => {
+      // A login redirect comes back as HTML; keep the queue until the session is back
+      const type = res.headers.get('Content-Type') || '';
+      if (!res.ok || !type.includes('application/json')) throw new Error('sync rejected');
+      return res.json();
+    })).then(body => queueDelete(body.results.map(r => r.id)).then(() => notify(body.results)));
+  }).finally(() => { replaying = null; });
+  return replaying;
+}
+
+function notify(results) {
+  return self.clients.matchAll().then(clients =>
+    clients.forEach(c => c.postMessage({ kind: 'sync-results', results })));
+}
+
+self.addEventListener('sync', event => {
+  if (event.tag === 'mileage-replay') event.waitUntil(replay());
+});
+
+self.addEventListener('message', event => {
+  if (event.data === 'replay') event.waitUntil(replay().catch(() => null));
+});
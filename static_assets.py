@@ -0,0 +1,143 @@
+"""Static asset fingerprinting, pre-compression and response compression.
+
+`url_for('static', filename=...)` gets a `?v=<content hash>` appended, and a
+request carrying the current hash is served with a year-long immutable
+Cache-Control, so phones only re-download an asset when its content changes.
+Pre-compressed `.br` / `.gz` siblings (written by `python static_assets.py`)
+are served when the client accepts them. HTML pages are compressed on the fly.
+"""
+import os
+import gzip
+import hashlib
+import mimetypes
+
+from flask import current_app, request, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    import brotli  # optional; gzip is used when it's missing
+except ImportError:
+    brotli = None
+
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+
+ONE_YEAR = 365 * 24 * 3600
+COMPRESSIBLE_EXTS = ('.css', '.js', '.svg', '.ico', '.webmanifest', '.json', '.txt', '.html')
+MIN_COMPRESS_SIZE = 512
+
+# {abs path: (mtime, hash)}
+_hash_cache = {}
+
+
+def static_hash(filename: str):
+    """Short content hash of a file in the static folder (None if it doesn't exist)."""
+    path = safe_join(current_app.static_folder, filename)
+    if not path or not os.path.isfile(path):
+        return None
+    mtime = os.path.getmtime(path)
+    cached = _hash_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    _hash_cache[path] = (mtime, digest)
+    return digest
+
+
+def _add_fingerprint(endpoint, values):
+    if endpoint != 'static' or 'filename' not in values or 'v' in values:
+        return
+    digest = static_hash(values['filename'])
+    if digest:
+        values['v'] = digest
+
+
+def _precompressed_variant(filename):
+    """Pick a .br/.gz sibling the client accepts and that is not older than the original."""
+    folder = current_app.static_folder
+    original = safe_join(folder, filename)
+    if not original or not os.path.isfile(original):
+        return None, None
+    for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+        if encoding not in request.accept_encodings:
+            continue
+        candidate = original + ext
+        if os.path.isfile(candidate) and os.path.getmtime(candidate) >= os.path.getmtime(original):
+            return filename + ext, encoding
+    return None, None
+
+
+def send_static(filename):
+    """Replacement for Flask's static view: precompressed variants + immutable caching."""
+    folder = current_app.static_folder
+    variant, encoding = _precompressed_variant(filename)
+    if variant:
+        resp = send_from_directory(folder, variant, mimetype=mimetypes.guess_type(filename)[0])
+        resp.headers['Content-Encoding'] = encoding
+    else:
+        resp = send_from_directory(folder, filename)
+    resp.vary.add('Accept-Encoding')
+
+    version = request.args.get('v')
+    if version and version == static_hash(filename):
+        resp.cache_control.no_cache = None
+        resp.cache_control.public = True
+        resp.cache_control.max_age = ONE_YEAR
+        resp.cache_control.immutable = True
+        resp.expires = None
+    return resp
+
+
+def compress_response(resp):
+    """after_request hook: gzip/brotli HTML pages for clients that accept it."""
+    if (resp.status_code != 200 or resp.direct_passthrough or resp.is_streamed
+            or resp.mimetype != 'text/html' or 'Content-Encoding' in resp.headers):
+        return resp
+    data = resp.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return resp
+    accept = request.accept_encodings
+    if brotli is not None and 'br' in accept:
+        resp.set_data(brotli.compress(data, quality=5))
+        resp.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in accept:
+        resp.set_data(gzip.compress(data, compresslevel=6))
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        return resp
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def init_app(app):
+    app.url_defaults(_add_fingerprint)
+    app.view_functions['static'] = send_static
+    app.after_request(compress_response)
+
+
+def precompress(static_dir: str):
+    """Write .gz (and .br when brotli is installed) next to every compressible static file."""
+    written = []
+    for root, _dirs, files in os.walk(static_dir):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE_EXTS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < MIN_COMPRESS_SIZE:
+                continue
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9))
+            written.append(path + '.gz')
+            if brotli is not None:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+                written.append(path + '.br')
+    return written
+
+
+if __name__ == '__main__':
+    here = os.path.abspath(os.path.dirname(__file__))
+    for path in precompress(os.path.join(here, 'static')):
+        print(path)
@@ -0,0 +1,319 @@
+"""Load-test harness: simulate several phones hitting the tracker at once.
+
+Starts the app against a throwaway SQLite database (or targets --url), seeds
+history, then runs --concurrency clients for --duration seconds. Each client
+logs in as its own user and repeatedly picks an operation from the mix:
+
+    list         GET /trips, /work/list, /finish_trip, /dashboard
+    finish_trip  POST /new_trip, GET /finish_trip, POST /finish_trip
+    work_end     POST /work/start, GET /work/list, POST /work/end/<id>
+    export       GET /export_data?format=csv, GET /work/export
+
+Reports per-route p50/p95/p99 latency, throughput, 5xx errors and
+"database is locked" errors (counted from the server's log when we started it).
+
+    python tools/loadtest.py --concurrency 8 --duration 30
+    python tools/loadtest.py --server-cmd "gunicorn -w 4 -b 127.0.0.1:{port} app:app"
+    python tools/loadtest.py --mix list=6,finish_trip=2,work_end=1,export=1 --json out.json
+
+Standard library only, so it runs on the Pi as-is.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shlex
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+PASSWORD = 'loadtest'
+DEFAULT_MIX = 'list=5,finish_trip=2,work_end=2,export=1'
+
+SEED_SCRIPT = """
+import sys
+from datetime import date, timedelta
+from app import app
+from database import db, User, Trip, WorkDay, create_user
+clients, history, password = int(sys.argv[1]), int(sys.argv[2]), sys.argv[3]
+with app.app_context():
+    for i in range(clients):
+        name = f'load{i}'
+        u = User.query.filter_by(username=name).first() or create_user(name, password)
+        for n in range(history):
+            d = date(2024, 1, 1) + timedelta(days=n % 365)
+            t = Trip(d.isoformat(), '18:00', 'Soccer', f'Venue {n % 25}', 'Home', 'Away', 1000.0 + n,
+                     user_id=u.id)
+            t.odometer_end, t.miles, t.amount_paid, t.status = 1030.0 + n, 30.0, 60.0, 'completed'
+            db.session.add(t)
+            db.session.add(WorkDay(user_id=u.id, day=d, status='ended', start_odo=n * 10, end_odo=n * 10 + 8))
+    db.session.commit()
+"""
+
+
+# -----------------------------
+# Server management
+# -----------------------------
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class LocalServer:
+    """The app on a temp database; stderr is scanned for lock errors per route."""
+
+    EXC_RE = re.compile(r'Exception on (\S+) \[(\w+)\]')
+
+    def __init__(self, server_cmd, clients, history):
+        self.port = _free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.db_dir = tempfile.mkdtemp(prefix='mileage-load-')
+        self.env = dict(os.environ, DATABASE_DIR=self.db_dir,
+                        DATABASE_PATH=os.path.join(self.db_dir, 'mileage_tracker.db'))
+        self.lock_errors = defaultdict(int)
+        self._last_route = None
+        self.proc = None
+        try:
+            subprocess.run([sys.executable, '-c', SEED_SCRIPT, str(clients), str(history), PASSWORD],
+                           cwd=ROOT, env=self.env, check=True)
+            if server_cmd:
+                cmd = shlex.split(server_cmd.format(port=self.port))
+            else:
+                cmd = [sys.executable, '-m', 'flask', '--app', 'app', 'run',
+                       '--port', str(self.port), '--with-threads']
+            self.proc = subprocess.Popen(cmd, cwd=ROOT, env=self.env, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.PIPE, text=True)
+            threading.Thread(target=self._scan_log, daemon=True).start()
+            self._wait_ready()
+        except BaseException:
+            self.stop()
+            raise
+
+    def _scan_log(self):
+        for line in self.proc.stderr:
+            m = self.EXC_RE.search(line)
+            if m:
+                self._last_route = f'{m.group(2)} {route_key(m.group(1))}'
+            elif 'database is locked' in line and self._last_route:
+                self.lock_errors[self._last_route] += 1
+                self._last_route = None  # one count per exception
+
+    def _wait_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError('server exited during startup')
+            try:
+                urllib.request.urlopen(self.url + '/login', timeout=1)
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError('server did not become ready')
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        shutil.rmtree(self.db_dir, ignore_errors=True)
+
+
+# -----------------------------
+# Clients
+# -----------------------------
+def route_key(path):
+    path = urllib.parse.urlsplit(path).path
+    return re.sub(r'/\d+', '/<id>', path)
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Time the POST itself, not the page it redirects to
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, key, seconds, ok):
+        with self.lock:
+            self.latencies[key].append(seconds)
+            if not ok:
+                self.errors[key] += 1
+
+
+class Client:
+    def __init__(self, base_url, username, stats):
+        self.base = base_url
+        self.stats = stats
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+        self.username = username
+        self.odometer = 100000.0
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base + path, data=body, method=method)
+        start = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=60) as resp:
+                text, status = resp.read().decode('utf-8', 'replace'), resp.status
+        except urllib.error.HTTPError as e:
+            text, status = e.read().decode('utf-8', 'replace'), e.code
+        except OSError:
+            text, status = '', 599
+        self.stats.record(f'{method} {route_key(path)}', time.perf_counter() - start, status < 500)
+        return status, text
+
+    def login(self):
+        status, _ = self.request('POST', '/login', {'username': self.username, 'password': PASSWORD})
+        return status == 302
+
+    # Operations -------------------------------------------------------------
+    def op_list(self):
+        self.request('GET', random.choice(['/trips', '/work/list', '/finish_trip', '/dashboard']))
+
+    def op_finish_trip(self):
+        self.request('POST', '/new_trip', {
+            'date': time.strftime('%Y-%m-%d'), 'time': '18:00', 'sport': 'Basketball',
+            'venue': f'Venue {random.randint(0, 24)}', 'home_team': 'Home', 'away_team': 'Away',
+            'odometer_start': self.odometer,
+        })
+        _, page = self.request('GET', '/finish_trip')
+        ids = re.findall(r'<option value="(\d+)"', page)
+        if ids:
+            self.odometer += random.randint(5, 60)
+            self.request('POST', '/finish_trip', {
+                'trip_id': ids[0], 'odometer_end': self.odometer,
+                'amount_paid': 55, 'Level_of_Play': 'Varsity',
+            })
+
+    def op_work_end(self):
+        self.request('POST', '/work/start', {'day': time.strftime('%Y-%m-%d'), 'start_odo': int(self.odometer)})
+        _, page = self.request('GET', '/work/list')
+        ids = re.findall(r'/work/end/(\d+)', page)
+        if ids:
+            self.odometer += random.randint(5, 40)
+            self.request('POST', f'/work/end/{ids[0]}', {'end_odo': int(self.odometer), 'append_segments': 'Office'})
+
+    def op_export(self):
+        self.request('GET', random.choice(['/export_data?format=csv', '/work/export']))
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if not hasattr(Client, f'op_{name.strip()}'):
+            raise SystemExit(f'unknown operation in --mix: {name}')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def run_client(client, mix, stop_at):
+    if not client.login():
+        return
+    names, weights = list(mix), list(mix.values())
+    while time.time() < stop_at:
+        getattr(client, f'op_{random.choices(names, weights)[0]}')()
+
+
+# -----------------------------
+# Reporting
+# -----------------------------
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def summarize(stats, lock_errors, elapsed):
+    rows = []
+    for key in sorted(stats.latencies):
+        lat = sorted(stats.latencies[key])
+        rows.append({
+            'route': key,
+            'requests': len(lat),
+            'rps': len(lat) / elapsed,
+            'p50_ms': percentile(lat, 50) * 1000,
+            'p95_ms': percentile(lat, 95) * 1000,
+            'p99_ms': percentile(lat, 99) * 1000,
+            'errors': stats.errors.get(key, 0),
+            'lock_errors': lock_errors.get(key, 0),
+        })
+    return rows
+
+
+def print_table(rows, elapsed):
+    header = f"{'route':32} {'reqs':>6} {'req/s':>7} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} {'5xx':>5} {'locked':>6}"
+    print(header)
+    print('-' * len(header))
+    for r in rows:
+        print(f"{r['route']:32} {r['requests']:6d} {r['rps']:7.1f} {r['p50_ms']:8.1f} {r['p95_ms']:8.1f} "
+              f"{r['p99_ms']:8.1f} {r['errors']:5d} {r['lock_errors']:6d}")
+    total = sum(r['requests'] for r in rows)
+    print('-' * len(header))
+    print(f"{'total':32} {total:6d} {total / elapsed:7.1f} "
+          f"{'':8} {'':8} {'':8} {sum(r['errors'] for r in rows):5d} {sum(r['lock_errors'] for r in rows):6d}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--concurrency', type=int, default=4, help='simulated phones (default 4)')
+    ap.add_argument('--duration', type=float, default=20, help='seconds to run (default 20)')
+    ap.add_argument('--mix', default=DEFAULT_MIX, help=f'operation weights (default {DEFAULT_MIX})')
+    ap.add_argument('--history', type=int, default=200, help='seeded trips and work days per user')
+    ap.add_argument('--server-cmd', help='command to start the app, with {port}; default: flask run --with-threads')
+    ap.add_argument('--url', help='target an already running instance instead (users load0.. must exist '
+                                  f'with password {PASSWORD!r}; lock errors are not counted)')
+    ap.add_argument('--json', help='also write the results to this file')
+    args = ap.parse_args(argv)
+    mix = parse_mix(args.mix)
+
+    server = None if args.url else LocalServer(args.server_cmd, args.concurrency, args.history)
+    base = args.url or server.url
+    stats = Stats()
+    try:
+        start = time.time()
+        stop_at = start + args.duration
+        threads = [threading.Thread(target=run_client, args=(Client(base, f'load{i}', stats), mix, stop_at))
+                   for i in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        time.sleep(0.5)  # let the log reader catch up
+    finally:
+        if server:
+            server.stop()
+
+    rows = summarize(stats, server.lock_errors if server else {}, elapsed)
+    print(f'{args.concurrency} clients, {elapsed:.1f}s, mix {args.mix}')
+    print_table(rows, elapsed)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'concurrency': args.concurrency, 'duration': elapsed, 'mix': mix, 'routes': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()